@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンチマークスクリプト - ステルスメタデータ（NovelAI形式）の読み取り速度を計測
+"""
+
+import gzip
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from extract_prompts import PromptExtractor
+
+
+def embed_stealth(img: Image.Image, text: str, compressed: bool = True) -> Image.Image:
+    """アルファチャンネルの最下位ビットにステルスメタデータを埋め込む"""
+    signature = b'stealth_pngcomp' if compressed else b'stealth_pnginfo'
+    payload = gzip.compress(text.encode('utf-8')) if compressed else text.encode('utf-8')
+    data = signature + (len(payload) * 8).to_bytes(4, 'big') + payload
+
+    pixels = np.array(img.convert('RGBA'))
+    height, width = pixels.shape[:2]
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    if len(bits) > height * width:
+        raise ValueError("画像が小さすぎます")
+
+    # 列優先（左の列から、各列を上から下へ）に書き込む
+    alpha = pixels[:, :, 3].T.copy()
+    flat = alpha.ravel()
+    flat[:len(bits)] = (flat[:len(bits)] & 0xFE) | bits
+    pixels[:, :, 3] = flat.reshape(width, height).T
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def decode_per_pixel(file_path: Path) -> str:
+    """比較用: 1ピクセルずつPythonのループで読み取る素朴な実装"""
+    with Image.open(file_path) as img:
+        img = img.convert('RGBA')
+        width, height = img.size
+        pixel_access = img.load()
+        bits = []
+        for x in range(width):
+            for y in range(height):
+                bits.append(str(pixel_access[x, y][3] & 1))
+    bits = ''.join(bits)
+    length = int(bits[120:152], 2)
+    payload = int(bits[152:152 + length], 2).to_bytes(length // 8, 'big')
+    return gzip.decompress(payload).decode('utf-8')
+
+
+def create_images(folder: Path, count: int, size: int):
+    """ステルスメタデータ付き画像とメタデータなし画像を作成"""
+    rng = np.random.default_rng(0)
+    info = {
+        'Description': 'masterpiece, best quality, 1girl, solo, long hair',
+        'Software': 'NovelAI',
+        'Comment': json.dumps({'prompt': 'masterpiece, best quality, 1girl, solo, long hair'}),
+    }
+    for i in range(count):
+        pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels, 'RGB')
+        embed_stealth(img, json.dumps(info)).save(folder / f'stealth_{i}.png')
+        img.convert('RGBA').save(folder / f'plain_{i}.png')
+
+
+def measure(label: str, func, files):
+    """1ファイルずつ処理して枚数/秒を表示"""
+    start = time.perf_counter()
+    for file_path in files:
+        func(file_path)
+    elapsed = time.perf_counter() - start
+    print(f"  {label}: {len(files) / elapsed:8.1f} 枚/秒 ({elapsed:.2f}秒)")
+
+
+def main():
+    """ベンチマーク実行"""
+    parser = argparse.ArgumentParser(description='ステルスメタデータの読み取り速度を計測します')
+    parser.add_argument('--count', type=int, default=20, help='画像の枚数（デフォルト: 20）')
+    parser.add_argument('--size', type=int, default=1024, help='画像の一辺のピクセル数（デフォルト: 1024）')
+    parser.add_argument('--skip-naive', action='store_true', help='素朴な実装との比較を省略')
+    args = parser.parse_args()
+
+    extractor = PromptExtractor()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        folder = Path(temp_dir)
+        create_images(folder, args.count, args.size)
+        stealth_files = sorted(folder.glob('stealth_*.png'))
+        plain_files = sorted(folder.glob('plain_*.png'))
+
+        # 正しく読めることを確認
+        prompt = extractor.extract_prompt_from_png(stealth_files[0])
+        assert prompt == 'masterpiece, best quality, 1girl, solo, long hair', prompt
+
+        print(f"画像サイズ: {args.size}x{args.size}, 枚数: {args.count}")
+        measure("ステルスあり（NumPy）", extractor.extract_prompt_from_png, stealth_files)
+        measure("ステルスなし（早期打ち切り）", extractor.extract_prompt_from_png, plain_files)
+        if not args.skip_naive:
+            measure("ステルスあり（ピクセル単位のループ）", decode_per_pixel, stealth_files[:max(1, args.count // 10)])
+
+
+if __name__ == '__main__':
+    main()
@@ -112,7 +112,6 @@ def create_portable_package():
 
 注意事項:
 - PNG画像のみ対応しています
-- 最大1,000枚まで処理可能です
 - Windows Defenderが警告を出す場合は「詳細情報」→「実行」を選択してください
 """
     
@@ -5,14 +5,22 @@ Stable Diffusionメタデータ抽出ツール
 PNG画像からポジティブプロンプトを抽出してテキストファイルに出力
 """
 
+import io
 import os
+import queue
 import sys
 import argparse
+import hashlib
+import json
 import logging
+import struct
+import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional, Tuple, List
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, Tuple, List, Dict, Iterator, Iterable, NamedTuple, Union
 import time
 import platform
 
@@ -21,13 +29,114 @@ from PIL.PngImagePlugin import PngInfo
 import piexif
 from tqdm import tqdm
 
+from prompt_store import PromptStore
+
+
+# PNGファイルのシグネチャ
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# テキストチャンクの種類
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+
+# プロンプトを探すテキストチャンクのキー（優先順位順）
+PROMPT_KEYS = ('parameters', 'Prompt', 'Description')
+
+# テキストチャンク展開後の上限サイズ（チャンク単位・ファイル単位）
+MAX_TEXT_CHUNK_BYTES = 1024 * 1024
+MAX_TEXT_FILE_BYTES = 4 * 1024 * 1024
+
+# NovelAI形式のステルスメタデータのシグネチャ（(アルファチャンネルか, gzip圧縮か)）
+STEALTH_SIGNATURES = {
+    b'stealth_pnginfo': (True, False),
+    b'stealth_pngcomp': (True, True),
+    b'stealth_rgbinfo': (False, False),
+    b'stealth_rgbcomp': (False, True),
+}
+STEALTH_SIGNATURE_BITS = 15 * 8
+STEALTH_LENGTH_BITS = 32
+
+# チャンクデータ・ファイルの読み込み単位
+READ_BLOCK_SIZE = 64 * 1024
+
+# 抽出結果をキャッシュする件数
+PROMPT_CACHE_SIZE = 4096
+
+# 破損ファイルの分類
+TRIAGE_ZERO_BYTE = 'zero_byte'      # 0バイト
+TRIAGE_NOT_PNG = 'not_png'          # PNGシグネチャがない
+TRIAGE_TRUNCATED = 'truncated'      # IENDまでに途切れている
+TRIAGE_BAD_CHUNK = 'bad_chunk'      # チャンクの長さ・種別が不正
+TRIAGE_BAD_CRC = 'bad_crc'          # メタデータチャンクのCRC不一致
+TRIAGE_TIMEOUT = 'timeout'          # 読み込みが制限時間内に終わらない
+TRIAGE_UNREADABLE = 'unreadable'    # 読み込みエラー
+
+# CRCを確認するチャンク
+CRC_CHECK_CHUNK_TYPES = (b'IHDR', b'eXIf') + TEXT_CHUNK_TYPES
+
+# PNG仕様上のチャンク長の上限
+MAX_CHUNK_LENGTH = 2 ** 31 - 1
+
+# トリアージの1ファイルあたりの制限時間（秒）
+TRIAGE_TIMEOUT_SECONDS = 10.0
+
+
+class _BufferStream:
+    """memoryviewをコピーせずに読み進める最小限のバイナリストリーム"""
+    
+    def __init__(self, data):
+        self._view = memoryview(data).cast('B')
+        self._pos = 0
+    
+    def read(self, size: int) -> memoryview:
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = min(max(offset, 0), len(self._view))
+        return self._pos
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def to_file(self) -> io.BytesIO:
+        """PILで開くためのファイルオブジェクト（ここで初めて全体をコピーする）"""
+        return io.BytesIO(self._view)
+
+
+def _file_digest(file_path: Path) -> str:
+    """ファイル全体のハッシュ値（16進文字列）"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(READ_BLOCK_SIZE * 16)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
 
 class PromptExtractor:
     """PNG画像からプロンプトを抽出するクラス"""
     
-    def __init__(self, output_encoding='utf-8'):
+    def __init__(self, output_encoding='utf-8',
+                 max_chunk_bytes: int = MAX_TEXT_CHUNK_BYTES,
+                 max_file_bytes: int = MAX_TEXT_FILE_BYTES,
+                 cache_size: int = PROMPT_CACHE_SIZE):
         self.output_encoding = output_encoding
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_file_bytes = max_file_bytes
         self.logger = logging.getLogger(__name__)
+        
+        # メタデータ（またはファイル全体）のハッシュ → 抽出結果のLRUキャッシュ
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
     
     def extract_prompt_from_png(self, file_path: Path) -> Optional[str]:
         """
@@ -40,37 +149,576 @@ class PromptExtractor:
             抽出したプロンプト文字列、見つからない場合はNone
         """
         try:
-            with Image.open(file_path) as img:
-                # PNGのテキストチャンクを確認
-                if hasattr(img, 'text'):
-                    # 優先順位: parameters > Prompt > Description
-                    for key in ['parameters', 'Prompt', 'Description']:
-                        if key in img.text:
-                            prompt = self._extract_positive_prompt(img.text[key])
-                            if prompt:
-                                return prompt
-                
-                # EXIFデータを確認
-                if hasattr(img, '_getexif') and img._getexif():
-                    exif_dict = piexif.load(img.info.get('exif', b''))
-                    if piexif.ExifIFD.UserComment in exif_dict.get('Exif', {}):
-                        user_comment = exif_dict['Exif'][piexif.ExifIFD.UserComment]
-                        # バイト列をデコード
-                        if isinstance(user_comment, bytes):
-                            try:
-                                comment_str = user_comment.decode('utf-8', errors='ignore')
-                                prompt = self._extract_positive_prompt(comment_str)
-                                if prompt:
-                                    return prompt
-                            except:
-                                pass
-                
-                return None
+            with open(file_path, 'rb') as f:
+                if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                    # 拡張子だけPNGの画像などはPILに任せる
+                    return self._extract_with_pil(file_path)
+                prompt = self._extract_from_stream(f, file_path)
+                if prompt is None:
+                    # メタデータがない場合は画素に埋め込まれたものを探す
+                    f.seek(0)
+                    prompt = self._extract_stealth_prompt(f, file_path)
+                return prompt
                 
         except Exception as e:
             self.logger.error(f"エラー発生 ({file_path}): {str(e)}")
             return None
     
+    def extract_prompt_with_hash(self, file_path: Path) -> Tuple[Optional[str], Optional[str]]:
+        """
+        ファイル全体のハッシュを計算してからプロンプトを抽出
+        
+        同じ内容のファイルを処理済みの場合は解析を省略する。
+        
+        Args:
+            file_path: PNG画像のパス
+            
+        Returns:
+            (プロンプト文字列, ファイル全体のハッシュ値) のタプル
+        """
+        try:
+            file_hash = _file_digest(file_path)
+        except OSError as e:
+            self.logger.error(f"エラー発生 ({file_path}): {str(e)}")
+            return None, None
+        
+        hit, prompt = self._cache_get(('file', file_hash))
+        if not hit:
+            prompt = self.extract_prompt_from_png(file_path)
+            self._cache_put(('file', file_hash), prompt)
+        return prompt, file_hash
+    
+    def extract_prompt_from_buffer(self, data, source='<buffer>') -> Optional[str]:
+        """
+        メモリ上のPNGデータからポジティブプロンプトを抽出
+        
+        データはmemoryview経由で参照し、チャンクの読み込みでコピーしない。
+        
+        Args:
+            data: PNGデータ（bytes / bytearray / memoryview など）
+            source: ログ出力用の名前
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        try:
+            stream = _BufferStream(data)
+            if stream.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return self._extract_with_pil(io.BytesIO(data))
+            prompt = self._extract_from_stream(stream, source)
+            if prompt is None:
+                # シグネチャの確認まではコピーせずに読む
+                stream.seek(0)
+                prompt = self._extract_stealth_prompt(stream, source)
+            return prompt
+        
+        except Exception as e:
+            self.logger.error(f"エラー発生 ({source}): {str(e)}")
+            return None
+    
+    def _extract_from_stream(self, f, source) -> Optional[str]:
+        """
+        シグネチャ確認済みのPNGストリームからプロンプトを抽出
+        
+        メタデータチャンクの生データのハッシュが一致する結果が
+        キャッシュにあれば、展開・解析を行わずにそれを返す。
+        
+        Args:
+            f: シグネチャの直後を指すバイナリストリーム
+            source: ログ出力用のファイル名
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        chunks, exif = self._read_png_metadata(f, source)
+        if not chunks and not exif:
+            return None
+        
+        key = ('meta', self._metadata_digest(chunks, exif))
+        hit, prompt = self._cache_get(key)
+        if hit:
+            return prompt
+        
+        prompt = self._parse_metadata(chunks, exif, source)
+        self._cache_put(key, prompt)
+        return prompt
+    
+    def _parse_metadata(self, chunks: Dict[str, Tuple[bytes, bytes, bool]],
+                        exif: Optional[bytes], source) -> Optional[str]:
+        """
+        読み込んだチャンクを優先順位順に展開してプロンプトを抽出
+        
+        Args:
+            chunks: キーと (チャンク種別, キーワード以降の生データ, 読み込みを打ち切ったか) の辞書
+            exif: EXIFの生データ
+            source: ログ出力用のファイル名
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        budget = self.max_file_bytes
+        
+        # PNGのテキストチャンクを確認
+        # 優先順位: parameters > Prompt > Description
+        for key in PROMPT_KEYS:
+            if key not in chunks:
+                continue
+            if budget <= 0:
+                self.logger.warning(
+                    f"テキストチャンクの合計が上限を超えたため読み飛ばしました "
+                    f"({source}: {key}, 上限 {self.max_file_bytes} バイト)"
+                )
+                break
+            chunk_type, raw, truncated = chunks[key]
+            limit = min(self.max_chunk_bytes, budget)
+            try:
+                text, size, output_truncated = self._decode_text_chunk(chunk_type, raw, limit)
+            except (ValueError, zlib.error) as e:
+                self.logger.warning(f"テキストチャンクを読めません ({source}: {key}): {str(e)}")
+                continue
+            if truncated or output_truncated:
+                self.logger.warning(
+                    f"テキストチャンクを切り詰めました "
+                    f"({source}: {key}, 上限 {limit} バイト)"
+                )
+            budget -= size
+            prompt = self._extract_positive_prompt(text)
+            if prompt:
+                return prompt
+        
+        # EXIFデータを確認
+        if exif:
+            return self._extract_prompt_from_exif(exif)
+        
+        return None
+    
+    @staticmethod
+    def _metadata_digest(chunks: Dict[str, Tuple[bytes, bytes, bool]],
+                         exif: Optional[bytes]) -> bytes:
+        """
+        プロンプト抽出に使うチャンクの生データのハッシュ値
+        
+        Args:
+            chunks: _read_png_metadataで読み込んだテキストチャンク
+            exif: EXIFの生データ
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for key in PROMPT_KEYS:
+            if key in chunks:
+                chunk_type, raw, _ = chunks[key]
+                digest.update(chunk_type + key.encode('latin-1') + struct.pack('>I', len(raw)))
+                digest.update(raw)
+        if exif:
+            digest.update(b'eXIf')
+            digest.update(exif)
+        return digest.digest()
+    
+    def _cache_get(self, key) -> Tuple[bool, Optional[str]]:
+        """
+        キャッシュから抽出結果を取得
+        
+        Returns:
+            (キャッシュにあったか, プロンプト文字列) のタプル
+        """
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return True, self._cache[key]
+        return False, None
+    
+    def _cache_put(self, key, prompt: Optional[str]):
+        """抽出結果をキャッシュに追加し、古いものから削除"""
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = prompt
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _extract_stealth_prompt(self, fp, source) -> Optional[str]:
+        """
+        アルファチャンネル（またはRGB）の最下位ビットに埋め込まれた
+        NovelAI形式のステルスメタデータからプロンプトを抽出
+        
+        ビットは列優先（左の列から、各列を上から下へ）に並ぶため、
+        シグネチャの確認には左端の列だけを自前で復元し、一致しなければ
+        画像全体をデコードせずに打ち切る。
+        
+        Args:
+            fp: PNGのバイナリストリーム（先頭位置）
+            source: ログ出力用のファイル名
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        import numpy as np
+        
+        head = self._decode_first_column(fp, STEALTH_SIGNATURE_BITS)
+        if head is not None:
+            pixels, has_alpha = head
+        else:
+            # 左端の列だけを復元できない形式は画像全体をデコードして確認
+            with self._open_image(fp) as img:
+                if img.mode not in ('RGB', 'RGBA'):
+                    return None
+                has_alpha = img.mode == 'RGBA'
+                pixels = np.asarray(img)
+        
+        compressed = None
+        for use_alpha in ((True, False) if has_alpha else (False,)):
+            signature = self._lsb_bytes(pixels, use_alpha, 0, STEALTH_SIGNATURE_BITS)
+            if signature in STEALTH_SIGNATURES and STEALTH_SIGNATURES[signature][0] == use_alpha:
+                compressed = STEALTH_SIGNATURES[signature][1]
+                break
+        if compressed is None:
+            return None
+        
+        # シグネチャが一致した場合のみ画像全体をデコード
+        if head is not None:
+            with self._open_image(fp) as img:
+                pixels = np.asarray(img)
+        
+        height, width = pixels.shape[:2]
+        capacity = height * width * (1 if use_alpha else 3)
+        header_bits = STEALTH_SIGNATURE_BITS + STEALTH_LENGTH_BITS
+        if capacity < header_bits:
+            return None
+        length = int.from_bytes(
+            self._lsb_bytes(pixels, use_alpha, STEALTH_SIGNATURE_BITS, STEALTH_LENGTH_BITS), 'big'
+        )
+        if length > capacity - header_bits or length // 8 > self.max_file_bytes:
+            self.logger.warning(f"ステルスメタデータの長さが不正です ({source}: {length} bit)")
+            return None
+        
+        payload = self._lsb_bytes(pixels, use_alpha, header_bits, length)
+        if compressed:
+            # gzip形式
+            data, truncated = self._inflate(payload, self.max_file_bytes, wbits=16 + zlib.MAX_WBITS)
+            if truncated:
+                self.logger.warning(
+                    f"ステルスメタデータを切り詰めました "
+                    f"({source}, 上限 {self.max_file_bytes} バイト)"
+                )
+            payload = data
+        text = payload.decode('utf-8', errors='ignore')
+        
+        # NovelAIはJSON（Description / Commentのprompt）、WebUIはparametersの文字列
+        try:
+            info = json.loads(text)
+        except ValueError:
+            info = None
+        if isinstance(info, dict):
+            for key in PROMPT_KEYS:
+                if isinstance(info.get(key), str):
+                    prompt = self._extract_positive_prompt(info[key])
+                    if prompt:
+                        return prompt
+            try:
+                comment = json.loads(info.get('Comment', ''))
+            except (TypeError, ValueError):
+                comment = None
+            if isinstance(comment, dict) and isinstance(comment.get('prompt'), str):
+                return self._extract_positive_prompt(comment['prompt'])
+            return None
+        return self._extract_positive_prompt(text)
+    
+    @staticmethod
+    def _open_image(fp) -> Image.Image:
+        """ストリームを先頭からPILで開く（_BufferStreamはこの時点でコピーする）"""
+        fp.seek(0)
+        if isinstance(fp, _BufferStream):
+            fp = fp.to_file()
+        return Image.open(fp)
+    
+    @staticmethod
+    def _decode_first_column(fp, rows: int):
+        """
+        PNGの左端の列を先頭rows行分だけ復元する
+        
+        IDATをrows行分だけ展開し、各行の先頭ピクセルのフィルタだけを戻す。
+        左端のピクセルは左隣・左上が0とみなされるため、前の行の同じ位置だけで復元できる。
+        対応するのは非インターレースの8bit RGB / RGBAのみで、それ以外や
+        高さがrows行未満の画像、データが壊れている場合はNoneを返す。
+        
+        Args:
+            fp: PNGのバイナリストリーム（先頭位置）
+            rows: 必要な行数
+            
+        Returns:
+            ((rows, 1, チャンネル数) の配列, アルファチャンネルがあるか)、復元できない場合はNone
+        """
+        import numpy as np
+        
+        if fp.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            return None
+        header = fp.read(8 + 13)
+        if len(header) < 8 + 13 or header[4:8] != b'IHDR':
+            return None
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header[8:])
+        channels = {2: 3, 6: 4}.get(color_type)
+        if channels is None or bit_depth != 8 or interlace or height < rows:
+            return None
+        fp.seek(4, io.SEEK_CUR)  # IHDRのCRC
+        
+        row_bytes = 1 + width * channels  # 先頭の1バイトはフィルタ種別
+        needed = rows * row_bytes
+        inflater = zlib.decompressobj()
+        data = bytearray()
+        in_idat = False
+        try:
+            while len(data) < needed:
+                chunk_header = fp.read(8)
+                if len(chunk_header) < 8:
+                    return None
+                length, chunk_type = struct.unpack('>I4s', chunk_header)
+                if chunk_type != b'IDAT':
+                    if in_idat or chunk_type == b'IEND':
+                        # IDATは連続しているため、途切れた時点でデータ不足
+                        return None
+                    fp.seek(length + 4, io.SEEK_CUR)
+                    continue
+                in_idat = True
+                remaining = length
+                while remaining and len(data) < needed:
+                    block = fp.read(min(remaining, READ_BLOCK_SIZE))
+                    if not block:
+                        return None
+                    remaining -= len(block)
+                    data += inflater.decompress(block, needed - len(data))
+                fp.seek(remaining + 4, io.SEEK_CUR)
+        except zlib.error:
+            return None
+        
+        column = bytearray()
+        previous = bytes(channels)
+        for row in range(rows):
+            start = row * row_bytes
+            filter_type = data[start]
+            raw = data[start + 1:start + 1 + channels]
+            if filter_type in (0, 1):
+                # None / Sub（左隣は0）
+                current = bytes(raw)
+            elif filter_type in (2, 4):
+                # Up / Paeth（左隣・左上が0なら予測値は上のピクセル）
+                current = bytes((x + b) & 0xFF for x, b in zip(raw, previous))
+            elif filter_type == 3:
+                # Average
+                current = bytes((x + (b >> 1)) & 0xFF for x, b in zip(raw, previous))
+            else:
+                return None
+            column += current
+            previous = current
+        pixels = np.frombuffer(bytes(column), dtype=np.uint8).reshape(rows, 1, channels)
+        return pixels, channels == 4
+    
+    @staticmethod
+    def _lsb_bytes(pixels, use_alpha: bool, start: int, count: int) -> bytes:
+        """
+        列優先に並べた最下位ビット列のうち、start bit目からcount bitをバイト列にする
+        
+        必要な列だけを切り出してNumPyでまとめて処理する。
+        
+        Args:
+            pixels: (高さ, 幅, チャンネル数) のNumPy配列
+            use_alpha: アルファチャンネルを使うか（FalseならRGBの3チャンネル）
+            start: 先頭からのビット位置
+            count: 取り出すビット数
+        """
+        import numpy as np
+        
+        channels = pixels[:, :, 3:4] if use_alpha else pixels[:, :, :3]
+        bits_per_column = channels.shape[0] * channels.shape[2]
+        first = start // bits_per_column
+        last = (start + count - 1) // bits_per_column + 1
+        bits = (channels[:, first:last] & 1).transpose(1, 0, 2).ravel()
+        offset = start - first * bits_per_column
+        return np.packbits(bits[offset:offset + count]).tobytes()
+    
+    def _extract_with_pil(self, fp) -> Optional[str]:
+        """
+        PNGシグネチャを持たないデータをPILで開いて抽出
+        
+        Args:
+            fp: 画像のパスまたはファイルオブジェクト
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        with Image.open(fp) as img:
+            if hasattr(img, 'text'):
+                for key in PROMPT_KEYS:
+                    if key in img.text:
+                        prompt = self._extract_positive_prompt(img.text[key])
+                        if prompt:
+                            return prompt
+            
+            if hasattr(img, '_getexif') and img._getexif():
+                return self._extract_prompt_from_exif(img.info.get('exif', b''))
+            
+            return None
+    
+    def _extract_prompt_from_exif(self, exif_data: bytes) -> Optional[str]:
+        """
+        EXIFのUserCommentからプロンプトを抽出
+        
+        Args:
+            exif_data: EXIFの生データ
+            
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        exif_dict = piexif.load(exif_data)
+        if piexif.ExifIFD.UserComment in exif_dict.get('Exif', {}):
+            user_comment = exif_dict['Exif'][piexif.ExifIFD.UserComment]
+            # バイト列をデコード
+            if isinstance(user_comment, bytes):
+                try:
+                    comment_str = user_comment.decode('utf-8', errors='ignore')
+                    return self._extract_positive_prompt(comment_str)
+                except:
+                    pass
+        return None
+    
+    def _read_png_metadata(self, f, source) -> Tuple[Dict[str, Tuple[bytes, bytes, bool]], Optional[bytes]]:
+        """
+        PNGのチャンクを走査し、必要なテキストチャンクとEXIFの生データだけを読み込む
+        
+        PROMPT_KEYS以外のキーのチャンク（ComfyUIのworkflowなど）は
+        読み込まずに読み飛ばす。読み込むデータはチャンク単位・ファイル単位の
+        上限までとし、展開は_decode_text_chunkで上限付きで行う。
+        
+        Args:
+            f: シグネチャの直後を指すバイナリストリーム
+            source: ログ出力用のファイル名
+            
+        Returns:
+            (キーと (チャンク種別, キーワード以降の生データ, 読み込みを打ち切ったか) の辞書,
+             EXIFの生データ) のタプル
+        """
+        chunks = {}
+        exif = None
+        budget = self.max_file_bytes
+        
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                # 途中で切れたファイルは読めた範囲で扱う
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            # 次のチャンクの位置（データ + CRC 4バイト）
+            next_pos = f.tell() + length + 4
+            
+            if chunk_type == b'IEND':
+                break
+            
+            if chunk_type in TEXT_CHUNK_TYPES:
+                # キーワードは最大79バイト + 区切りのNUL
+                head = bytes(f.read(min(length, 80)))
+                keyword, sep, _ = head.partition(b'\0')
+                key = keyword.decode('latin-1')
+                if sep and key in PROMPT_KEYS and key not in chunks:
+                    if budget <= 0:
+                        self.logger.warning(
+                            f"テキストチャンクの合計が上限を超えたため読み飛ばしました "
+                            f"({source}: {key}, 上限 {self.max_file_bytes} バイト)"
+                        )
+                    else:
+                        data_start = next_pos - 4 - length + len(keyword) + 1
+                        size = length - len(keyword) - 1
+                        read_size = min(size, self.max_chunk_bytes, budget)
+                        f.seek(data_start)
+                        raw = f.read(read_size)
+                        if len(raw) < read_size:
+                            self.logger.warning(
+                                f"テキストチャンクを読めません ({source}: {key}): "
+                                f"チャンクが途中で終わっています"
+                            )
+                            break
+                        chunks[key] = (chunk_type, raw, read_size < size)
+                        budget -= read_size
+            
+            elif chunk_type == b'eXIf' and exif is None:
+                if length <= self.max_chunk_bytes:
+                    exif = bytes(f.read(length))
+                else:
+                    self.logger.warning(
+                        f"EXIFが上限を超えたため読み飛ばしました "
+                        f"({source}: {length} バイト)"
+                    )
+            
+            f.seek(next_pos)
+        
+        return chunks, exif
+    
+    def _decode_text_chunk(self, chunk_type: bytes, raw,
+                           limit: int) -> Tuple[str, int, bool]:
+        """
+        キーワード以降のテキストチャンクのデータを上限付きで展開・デコード
+        
+        Args:
+            chunk_type: tEXt / zTXt / iTXt
+            raw: キーワードの区切り以降のデータ
+            limit: 展開後の最大バイト数
+            
+        Returns:
+            (テキスト, 展開後のバイト数, 切り詰めたかどうか) のタプル
+        """
+        raw = memoryview(raw)
+        
+        if chunk_type == b'tEXt':
+            data = raw[:limit]
+            return bytes(data).decode('latin-1'), len(data), len(raw) > limit
+        
+        if chunk_type == b'zTXt':
+            # 圧縮方式(1バイト) + 圧縮データ
+            if len(raw) < 1 or raw[0] != 0:
+                raise ValueError("未対応の圧縮方式です")
+            data, truncated = self._inflate(raw[1:], limit)
+            return data.decode('latin-1'), len(data), truncated
+        
+        # iTXt: 圧縮フラグ(1) + 圧縮方式(1) + 言語タグ\0 + 翻訳キーワード\0 + テキスト
+        if len(raw) < 2:
+            raise ValueError("チャンクのヘッダーが不正です")
+        compressed, method = raw[0], raw[1]
+        header = bytes(raw[2:2 + READ_BLOCK_SIZE])
+        end = header.find(b'\0')
+        end = header.find(b'\0', end + 1) if end != -1 else -1
+        if end == -1:
+            raise ValueError("チャンクのヘッダーが不正です")
+        body = raw[2 + end + 1:]
+        if compressed:
+            if method != 0:
+                raise ValueError("未対応の圧縮方式です")
+            data, truncated = self._inflate(body, limit)
+        else:
+            data, truncated = bytes(body[:limit]), len(body) > limit
+        # 切り詰めで途中になった文字は捨てる
+        return data.decode('utf-8', errors='ignore'), len(data), truncated
+    
+    @staticmethod
+    def _inflate(data, limit: int, wbits: int = zlib.MAX_WBITS) -> Tuple[bytes, bool]:
+        """
+        zlib圧縮データを上限付きで展開
+        
+        上限 + 1 バイトに達した時点で展開を止めるため、展開後のサイズに
+        関わらず使用メモリは上限程度に収まる。
+        
+        Args:
+            data: 圧縮データ
+            limit: 展開後の最大バイト数
+            wbits: zlib.decompressobjのwbits（gzip形式は16 + MAX_WBITS）
+            
+        Returns:
+            (展開したデータ, 切り詰めたかどうか) のタプル
+        """
+        decompressor = zlib.decompressobj(wbits)
+        output = decompressor.decompress(data, limit + 1)
+        if len(output) > limit:
+            return output[:limit], True
+        return output, False
+    
     def _extract_positive_prompt(self, text: str) -> Optional[str]:
         """
         テキストからポジティブプロンプトを抽出
@@ -115,34 +763,415 @@ class PromptExtractor:
         return prompt if prompt else None
 
 
+def triage_png(file_path: Path, check_crc: bool = False) -> Optional[Tuple[str, str]]:
+    """
+    画像データをデコードせずにPNGファイルの構造だけを確認
+    
+    シグネチャ、各チャンクの長さ・種別、IENDまで揃っているかを確認し、
+    check_crc指定時はIHDRとメタデータチャンクのCRCも照合する。
+    PNGシグネチャがなくてもPILで開ける画像は、抽出でPILに任せるため問題なしとする。
+    
+    Args:
+        file_path: PNG画像のパス
+        check_crc: メタデータチャンクのCRCを照合するか
+        
+    Returns:
+        問題がなければNone、あれば (分類, 詳細) のタプル
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        if file_size == 0:
+            return TRIAGE_ZERO_BYTE, "ファイルが空です"
+        
+        with open(file_path, 'rb') as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                # 拡張子だけPNGの画像（JPEGなど）は抽出側でPILが扱うため通す
+                f.seek(0)
+                try:
+                    with Image.open(f):
+                        return None
+                except (OSError, ValueError):
+                    return TRIAGE_NOT_PNG, "PNGシグネチャがなく、画像として開けません"
+            
+            buffer = bytearray(READ_BLOCK_SIZE)
+            pos = len(PNG_SIGNATURE)
+            first = True
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return TRIAGE_TRUNCATED, f"IENDチャンクの前で終わっています (offset {pos})"
+                length, chunk_type = struct.unpack('>I4s', header)
+                if length > MAX_CHUNK_LENGTH or not chunk_type.isalpha():
+                    return TRIAGE_BAD_CHUNK, f"チャンクが不正です (offset {pos})"
+                if first and chunk_type != b'IHDR':
+                    return TRIAGE_BAD_CHUNK, "先頭がIHDRチャンクではありません"
+                first = False
+                if pos + 12 + length > file_size:
+                    return TRIAGE_TRUNCATED, (
+                        f"{chunk_type.decode('ascii')}チャンクの途中で終わっています (offset {pos})"
+                    )
+                
+                if check_crc and chunk_type in CRC_CHECK_CHUNK_TYPES:
+                    # 固定バッファに読み込み、memoryview上でCRCを計算
+                    crc = zlib.crc32(chunk_type)
+                    view = memoryview(buffer)
+                    remaining = length
+                    while remaining > 0:
+                        size = f.readinto(view[:min(remaining, len(buffer))])
+                        if not size:
+                            return TRIAGE_TRUNCATED, f"チャンクの途中で終わっています (offset {pos})"
+                        crc = zlib.crc32(view[:size], crc)
+                        remaining -= size
+                    stored = f.read(4)
+                    if len(stored) < 4:
+                        return TRIAGE_TRUNCATED, f"CRCの途中で終わっています (offset {pos})"
+                    if struct.unpack('>I', stored)[0] != crc:
+                        return TRIAGE_BAD_CRC, (
+                            f"{chunk_type.decode('ascii')}チャンクのCRCが一致しません (offset {pos})"
+                        )
+                else:
+                    f.seek(length + 4, os.SEEK_CUR)
+                
+                pos += 12 + length
+                if chunk_type == b'IEND':
+                    return None
+    
+    except OSError as e:
+        return TRIAGE_UNREADABLE, str(e)
+
+
+class _DaemonExecutor(Executor):
+    """
+    デーモンスレッドで実行するExecutor
+    
+    ThreadPoolExecutorのスレッドはインタープリタ終了時にjoinされるため、
+    読み込みが止まったまま戻らないファイルがあると終了できなくなる。
+    こちらのスレッドは終了を妨げないので、応答のないスレッドを放置できる。
+    """
+    
+    def __init__(self, max_workers: int, thread_name_prefix: str = 'worker'):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._work, name=f'{thread_name_prefix}_{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('終了したExecutorにはタスクを投入できません')
+            future = Future()
+            self._queue.put((future, fn, args, kwargs))
+            return future
+    
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    task = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                task[0].cancel()
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+    
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            del task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            del future, fn, args, kwargs
+
+
+# _iter_with_deadlineで入力の終わりを示す値
+_END = object()
+
+
+def _iter_with_deadline(func, items: Iterable, workers: int,
+                        timeout: Optional[float],
+                        max_pending: int,
+                        executor: Optional[Executor] = None,
+                        thread_name_prefix: str = 'worker') -> Iterator[Tuple[object, Optional[Future]]]:
+    """
+    itemsの各要素にfuncを並列に適用し、完了した順に (要素, Future) を返す
+    
+    実行開始から制限時間を過ぎた要素は (要素, None) として返し、結果を待たずに先へ進む。
+    executor未指定時は応答のないスレッドが全て塞がると新しいスレッドで続行するが、
+    指定されたexecutorでは打ち切ったタスクのスレッドは戻るまで塞がったままになる。
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = _DaemonExecutor(workers, thread_name_prefix)
+    item_iter = iter(items)
+    pending = {}
+    started = {}
+    abandoned = 0
+    stuck = False
+    
+    def run(token, item):
+        started[token] = time.monotonic()
+        return func(item)
+    
+    def submit(item):
+        token = object()
+        pending[executor.submit(run, token, item)] = (token, item)
+    
+    try:
+        while True:
+            while len(pending) < max_pending:
+                item = next(item_iter, _END)
+                if item is _END:
+                    break
+                submit(item)
+            
+            if not pending:
+                return
+            
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                token, item = pending.pop(future)
+                started.pop(token, None)
+                yield item, future
+            
+            if timeout is None:
+                continue
+            # 制限時間を過ぎたタスクを打ち切る
+            now = time.monotonic()
+            for future, (token, item) in list(pending.items()):
+                if token in started and now - started[token] > timeout:
+                    del pending[future]
+                    started.pop(token, None)
+                    abandoned += 1
+                    stuck = True
+                    yield item, None
+            if own_executor and abandoned >= workers:
+                # 塞がったスレッドは放置し、残りを新しいスレッドで処理
+                executor.shutdown(wait=False)
+                executor = _DaemonExecutor(workers, thread_name_prefix)
+                for future, (token, item) in list(pending.items()):
+                    if future.cancel():
+                        del pending[future]
+                        submit(item)
+                abandoned = 0
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            # 応答のないスレッドが残っている場合は待たない
+            executor.shutdown(wait=not stuck)
+
+
+def iter_triage(paths: Iterable[Union[str, Path]], workers: int = 2,
+                check_crc: bool = False,
+                timeout: Optional[float] = TRIAGE_TIMEOUT_SECONDS,
+                max_pending: Optional[int] = None) -> Iterator[Tuple[Path, Optional[Tuple[str, str]]]]:
+    """
+    triage_pngを専用のスレッドで並列に実行し、完了した順に返す
+    
+    制限時間を過ぎたファイルはtimeoutとして扱い、結果を待たずに先へ進む。
+    応答のないファイルでスレッドが全て塞がった場合は新しいスレッドで続行する。
+    スレッドはデーモンスレッドのため、応答のないまま残ってもプロセスの終了は妨げない。
+    
+    Args:
+        paths: PNGファイルのパス
+        workers: トリアージ用のスレッド数
+        check_crc: メタデータチャンクのCRCを照合するか
+        timeout: 1ファイルあたりの制限時間（秒、Noneなら無制限）
+        max_pending: 同時に保持する結果の上限（省略時はworkersの4倍）
+        
+    Yields:
+        (パス, triage_pngの結果) のタプル
+    """
+    results = _iter_with_deadline(lambda path: triage_png(path, check_crc),
+                                  (Path(path) for path in paths), workers, timeout,
+                                  max_pending or workers * 4, thread_name_prefix='triage')
+    try:
+        for path, future in results:
+            if future is None:
+                yield path, (TRIAGE_TIMEOUT, f"{timeout}秒以内に読み込めませんでした")
+                continue
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, (TRIAGE_UNREADABLE, str(e))
+    finally:
+        results.close()
+
+
+class PromptResult(NamedTuple):
+    """1枚分の抽出結果"""
+    source: Union[Path, int]  # ファイルパス（バッファの場合は入力リスト内の位置）
+    prompt: Optional[str]     # 見つからない場合はNone
+    file_hash: Optional[str] = None  # ファイル全体のハッシュ値（hash_files指定時のみ）
+    problem: Optional[Tuple[str, str]] = None  # トリアージで除外した場合の (分類, 詳細)
+
+
+def iter_prompts(paths: Iterable[Union[str, Path]], workers: int = 4,
+                 executor: Optional[Executor] = None,
+                 max_pending: Optional[int] = None,
+                 extractor: Optional[PromptExtractor] = None,
+                 hash_files: bool = False,
+                 triage: bool = False, check_crc: bool = False,
+                 read_timeout: Optional[float] = TRIAGE_TIMEOUT_SECONDS,
+                 triage_workers: int = 2) -> Iterator[PromptResult]:
+    """
+    PNGファイルからプロンプトを並列に抽出し、完了した順に返す
+    
+    実行中・未取得の結果は常にmax_pending件以下に抑えるため、
+    呼び出し側の処理が遅い場合は新しいファイルの投入も止まる。
+    
+    抽出（ハッシュ計算・ステルス形式のデコードを含む）にもread_timeoutを適用し、
+    時間内に終わらないファイルはproblemに (timeout, 詳細) を入れて返す。
+    executorを指定した場合、打ち切ったタスクのスレッドは読み込みが戻るまで解放されない。
+    
+    Args:
+        paths: PNGファイルのパス
+        workers: executor未指定時に作成するスレッド数
+        executor: 使用するExecutor（指定時は終了処理を行わない）
+        max_pending: 同時に保持する結果の上限（省略時はworkersの2倍）
+        extractor: 使用するPromptExtractor
+        hash_files: ファイル全体のハッシュを計算し、同一ファイルの解析を省略するか
+        triage: 抽出の前に別スレッドでtriage_pngを行い、破損ファイルを除外するか
+        check_crc: トリアージでメタデータチャンクのCRCも照合するか
+        read_timeout: トリアージ・抽出それぞれの1ファイルあたりの制限時間（秒、Noneなら無制限）
+        triage_workers: トリアージ用のスレッド数
+        
+    Yields:
+        PromptResult
+    """
+    extractor = extractor or PromptExtractor()
+    extract = extractor.extract_prompt_with_hash if hash_files else extractor.extract_prompt_from_png
+    logger = logging.getLogger(__name__)
+    
+    if triage:
+        path_iter = iter_triage(paths, workers=triage_workers, check_crc=check_crc,
+                                timeout=read_timeout)
+    else:
+        path_iter = ((Path(path), None) for path in paths)
+    
+    def run(item):
+        path, problem = item
+        if problem:
+            # 破損ファイルは抽出に回さない
+            return None
+        return extract(path)
+    
+    results = _iter_with_deadline(run, path_iter, workers, read_timeout,
+                                  max_pending or workers * 2, executor,
+                                  thread_name_prefix='extract')
+    try:
+        for (path, problem), future in results:
+            if problem:
+                yield PromptResult(path, None, None, problem)
+                continue
+            if future is None:
+                logger.error(f"読み込みが{read_timeout}秒以内に終わりませんでした: {path.name}")
+                yield PromptResult(path, None, None,
+                                   (TRIAGE_TIMEOUT, f"{read_timeout}秒以内に抽出できませんでした"))
+                continue
+            file_hash = None
+            try:
+                if hash_files:
+                    prompt, file_hash = future.result()
+                else:
+                    prompt = future.result()
+            except Exception as e:
+                logger.error(f"処理エラー ({path.name}): {str(e)}")
+                prompt = None
+            yield PromptResult(path, prompt, file_hash)
+    finally:
+        # 途中で打ち切られた場合は未着手のタスクを取り消す
+        results.close()
+        path_iter.close()
+
+
+def extract_many(items: Iterable, workers: int = 4,
+                 executor: Optional[Executor] = None,
+                 extractor: Optional[PromptExtractor] = None) -> List[PromptResult]:
+    """
+    複数のPNGファイル・メモリ上のPNGデータからまとめてプロンプトを抽出
+    
+    bytes / bytearray / memoryview はコピーせずに解析し、
+    それ以外はファイルパスとして扱う。
+    
+    Args:
+        items: PNGデータまたはファイルパス
+        workers: executor未指定時に作成するスレッド数（1以下なら呼び出し元で逐次処理）
+        executor: 使用するExecutor（指定時は終了処理を行わない）
+        extractor: 使用するPromptExtractor
+        
+    Returns:
+        入力と同じ順序のPromptResultのリスト
+    """
+    extractor = extractor or PromptExtractor()
+    
+    def extract(index_item):
+        index, item = index_item
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            return PromptResult(index, extractor.extract_prompt_from_buffer(item, f'<buffer {index}>'))
+        path = Path(item)
+        return PromptResult(path, extractor.extract_prompt_from_png(path))
+    
+    indexed = enumerate(items)
+    if executor is not None:
+        return list(executor.map(extract, indexed))
+    if workers <= 1:
+        return [extract(index_item) for index_item in indexed]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(extract, indexed))
+
+
 class PromptProcessor:
     """プロンプト抽出処理の管理クラス"""
     
-    def __init__(self, target_folder: Path, max_workers: int = 4):
+    def __init__(self, target_folder: Path, max_workers: int = 4, dedup: bool = False,
+                 triage: bool = True, check_crc: bool = False,
+                 read_timeout: Optional[float] = TRIAGE_TIMEOUT_SECONDS,
+                 triage_workers: int = 2,
+                 spill_dir: Optional[Path] = None):
         self.target_folder = target_folder
         self.max_workers = max_workers
+        self.dedup = dedup
+        self.triage = triage
+        self.check_crc = check_crc
+        self.read_timeout = read_timeout
+        self.triage_workers = triage_workers
+        self.spill_dir = spill_dir
         self.extractor = PromptExtractor()
         self.logger = logging.getLogger(__name__)
+    
+    def _setup_logging(self) -> List[logging.Handler]:
+        """
+        ログ設定
         
-        # ログ設定
-        self._setup_logging()
+        組み込み先のログ設定を壊さないよう、このモジュールのロガーにハンドラを
+        追加するだけで、既存のハンドラや伝播の設定には触れない。
         
-        # Windows環境でのエンコーディング問題を回避
-        if sys.platform == 'win32':
-            import codecs
-            # stdout/stderrをUTF-8でラップ
-            if hasattr(sys.stdout, 'buffer'):
-                sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
-            if hasattr(sys.stderr, 'buffer'):
-                sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
-    
-    def _setup_logging(self):
-        """ログ設定"""
+        Returns:
+            追加したハンドラ（処理後に_teardown_loggingで外す）
+        """
         log_file = self.target_folder / 'error.log'
-        
-        # 既存のハンドラをクリア
-        logger = logging.getLogger()
-        logger.handlers = []
+        logger = self.logger
         
         # ファイルハンドラ（BOMなしUTF-8）
         file_handler = logging.FileHandler(log_file, encoding='utf-8', mode='a')
@@ -152,21 +1181,43 @@ class PromptProcessor:
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
         
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
-        logger.setLevel(logging.INFO)
+        handlers = [file_handler, console_handler]
+        for handler in handlers:
+            handler.setLevel(logging.INFO)
+            logger.addHandler(handler)
+        if logger.getEffectiveLevel() > logging.INFO:
+            logger.setLevel(logging.INFO)
+        return handlers
+    
+    def _teardown_logging(self, handlers: List[logging.Handler], level: int):
+        """_setup_loggingで追加したハンドラを外して閉じ、ロガーのレベルを戻す"""
+        for handler in handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.logger.setLevel(level)
     
     def process_folder(self) -> Tuple[str, int, int, float]:
         """
         フォルダ内のPNG画像を処理
         
+        処理中だけerror.logと標準出力へのログ出力を有効にする。
+        
         Returns:
             (出力ファイルパス, 処理件数, エラー件数, 処理時間)
         """
+        level = self.logger.level
+        handlers = self._setup_logging()
+        try:
+            return self._process_folder()
+        finally:
+            self._teardown_logging(handlers, level)
+    
+    def _process_folder(self) -> Tuple[str, int, int, float]:
+        """process_folderの本体"""
         start_time = time.time()
         
-        # PNG画像を収集
-        png_files = list(self.target_folder.glob('*.png'))
+        # PNG画像を収集（重複の元ファイルを処理順によらず決めるため名前順）
+        png_files = sorted(self.target_folder.glob('*.png'))
         if not png_files:
             self.logger.warning("PNG画像が見つかりませんでした。")
             return "", 0, 0, 0
@@ -177,34 +1228,58 @@ class PromptProcessor:
         
         success_count = 0
         error_count = 0
-        results = []
-        
-        # マルチスレッドで処理
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # タスクを投入
-            future_to_file = {
-                executor.submit(self._process_single_file, png_file): png_file
-                for png_file in png_files[:1000]  # 最大1000枚
-            }
-            
-            # プログレスバー付きで結果を収集
-            with tqdm(total=len(future_to_file), desc="処理中", unit="ファイル") as pbar:
-                for future in as_completed(future_to_file):
-                    png_file = future_to_file[future]
-                    try:
-                        result = future.result()
-                        if result:
-                            results.append(result)
-                            success_count += 1
-                        else:
-                            error_count += 1
-                    except Exception as e:
-                        self.logger.error(f"処理エラー ({png_file.name}): {str(e)}")
+        duplicates = []
+        quarantined = []
+        first_files = {}  # ファイルのハッシュ値 → 名前順で最初のファイル
+        same_files = []   # (重複ファイル, ハッシュ値)
+        
+        # (ファイル名, プロンプト) を省メモリのストアに保持（一時ファイルは書き込み後に削除）
+        with PromptStore(self.spill_dir) as results:
+            # マルチスレッドで処理し、プログレスバー付きで結果を収集
+            with tqdm(total=len(png_files), desc="処理中", unit="ファイル") as pbar:
+                for result in iter_prompts(png_files, workers=self.max_workers,
+                                           extractor=self.extractor, hash_files=self.dedup,
+                                           triage=self.triage, check_crc=self.check_crc,
+                                           read_timeout=self.read_timeout,
+                                           triage_workers=self.triage_workers):
+                    if result.problem:
+                        category, detail = result.problem
+                        quarantined.append((result.source.name, category, detail))
+                        self.logger.warning(f"破損ファイルを除外しました ({category}): {result.source.name} - {detail}")
+                        error_count += 1
+                        pbar.update(1)
+                        continue
+                    
+                    if result.file_hash:
+                        path = result.source
+                        original = first_files.setdefault(result.file_hash, path)
+                        if original != path:
+                            # 完了順に関係なく、名前順で先のファイルを元ファイルとする
+                            if path < original:
+                                first_files[result.file_hash], path = path, original
+                            same_files.append((path, result.file_hash))
+                    
+                    if result.prompt:
+                        results.append(result.source.name, result.prompt)
+                        success_count += 1
+                    else:
+                        self.logger.warning(f"プロンプトが見つかりません: {result.source.name}")
                         error_count += 1
                     pbar.update(1)
+            
+            for path, file_hash in sorted(same_files):
+                original = first_files[file_hash].name
+                duplicates.append((path.name, original))
+                self.logger.info(f"重複ファイル: {path.name} ({original} と同一)")
+            
+            # 結果をファイルに書き込み（追加を締め切り、コピーなしで読み出す）
+            results.freeze()
+            self._write_results(output_file, results, duplicates)
         
-        # 結果をファイルに書き込み
-        self._write_results(output_file, results)
+        quarantine_file = None
+        if quarantined:
+            quarantine_file = self.target_folder / f'quarantine_{timestamp}.yaml'
+            self._write_quarantine_report(quarantine_file, quarantined)
         
         elapsed_time = time.time() - start_time
         
@@ -213,6 +1288,10 @@ class PromptProcessor:
         print(f"  処理件数: {success_count + error_count}")
         print(f"  成功: {success_count}")
         print(f"  エラー: {error_count}")
+        if self.dedup:
+            print(f"  重複ファイル: {len(duplicates)}")
+        if quarantined:
+            print(f"  破損ファイル: {len(quarantined)}（{quarantine_file.name} に記録）")
         print(f"  処理時間: {elapsed_time:.2f}秒")
         
         # 出力ファイルの場所を強調表示
@@ -233,31 +1312,36 @@ class PromptProcessor:
         
         return str(output_file), success_count, error_count, elapsed_time
     
-    def _process_single_file(self, png_file: Path) -> Optional[Tuple[str, str]]:
-        """
-        単一ファイルを処理
-        
-        Args:
-            png_file: 処理対象のPNGファイル
-            
-        Returns:
-            (ファイル名, プロンプト) のタプル、エラーの場合はNone
-        """
-        prompt = self.extractor.extract_prompt_from_png(png_file)
-        if prompt:
-            return (png_file.name, prompt)
-        else:
-            self.logger.warning(f"プロンプトが見つかりません: {png_file.name}")
-            return None
-    
-    def _write_results(self, output_file: Path, results: List[Tuple[str, str]]):
+    def _write_results(self, output_file: Path, results: PromptStore,
+                       duplicates: Optional[List[Tuple[str, str]]] = None):
         """
         結果をファイルに書き込み（YAML形式とテキスト形式の両方）
         
+        dedup指定時は、同じプロンプトをYAMLではアンカー・エイリアスで参照し、
+        テキストでは1回だけ出力する。重複は各行のプロンプトの64bitハッシュ値を
+        配列に並べて数え、プロンプト本体やキーのバイト列は保持しない。
+        
         Args:
             output_file: 出力ファイルパス
-            results: (ファイル名, プロンプト) のリスト
+            results: 抽出結果のPromptStore
+            duplicates: (重複ファイル名, 元のファイル名) のリスト
         """
+        rows = range(len(results))
+        if self.dedup:
+            import numpy as np
+            
+            # 行ごとのハッシュ値を1回だけ計算し、各プロンプトの初出の行と出現回数を求める
+            digests = np.fromiter((results.prompt_digest(row) for row in rows),
+                                  dtype=np.uint64, count=len(results))
+            values, first_rows, counts = np.unique(digests, return_index=True, return_counts=True)
+            distinct_count = len(values)
+            first = np.zeros(len(results), dtype=bool)
+            first[first_rows] = True
+            # 2回以上出現するプロンプトだけアンカーを付ける（名前は初出の順に割り当て）
+            repeated = set(values[counts > 1].tolist())
+            del values, first_rows, counts
+        anchors = {}
+        
         # ファイル名を.yamlに変更
         yaml_file = output_file.with_suffix('.yaml')
         
@@ -266,30 +1350,73 @@ class PromptProcessor:
             # YAMLヘッダー
             f.write("# Stable Diffusion Prompts\n")
             f.write(f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"# Total images: {len(results)}\n\n")
+            f.write(f"# Total images: {len(results)}\n")
+            if self.dedup:
+                f.write(f"# Distinct prompts: {distinct_count}\n")
+            f.write("\n")
             
             # プロンプトデータ
             f.write("prompts:\n")
-            for filename, prompt in results:
+            for row in rows:
                 # ファイル名から拡張子を除いてキーを生成
-                key = filename.replace('.png', '')
+                key = results.filename(row).replace('.png', '')
+                if self.dedup and not first[row]:
+                    # 出力済みのプロンプトは参照のみ
+                    f.write(f"  {key}: *{anchors[int(digests[row])]}\n\n")
+                    continue
                 # プロンプトの改行を保持しつつ、YAMLのリテラルスタイルで出力
-                f.write(f"  {key}: |\n")
+                if self.dedup and int(digests[row]) in repeated:
+                    anchor = anchors[int(digests[row])] = f"p{len(anchors) + 1}"
+                    f.write(f"  {key}: &{anchor} |\n")
+                else:
+                    f.write(f"  {key}: |\n")
                 # プロンプトの各行をインデントして出力
-                for line in prompt.strip().split('\n'):
+                for line in results.prompt(row).strip().split('\n'):
                     f.write(f"    {line}\n")
                 f.write("\n")
+            
+            # 内容が同一のファイル
+            if duplicates:
+                f.write("duplicates:\n")
+                for filename, original in duplicates:
+                    f.write(f"  {filename.replace('.png', '')}: {original.replace('.png', '')}\n")
         
         # テキストファイルにプロンプトのみを保存
         txt_file = output_file.with_suffix('.txt')
         with open(txt_file, 'w', encoding='utf-8-sig' if sys.platform == 'win32' else 'utf-8') as f:
             # プロンプトのみを改行で区切って出力
-            for _, prompt in results:
-                f.write(prompt.strip())
+            for row in rows:
+                if self.dedup and not first[row]:
+                    continue
+                f.write(results.prompt(row).strip())
                 f.write("\n\n---\n\n")  # プロンプト間の区切り
             
         # 両方のファイルパスを返すためにタプルを作成
         self.output_files = (yaml_file, txt_file)
+    
+    def _write_quarantine_report(self, report_file: Path, quarantined: List[Tuple[str, str, str]]):
+        """
+        トリアージで除外したファイルを分類ごとにYAML形式で書き込み
+        
+        Args:
+            report_file: 出力ファイルパス
+            quarantined: (ファイル名, 分類, 詳細) のリスト
+        """
+        by_category = {}
+        for filename, category, detail in quarantined:
+            by_category.setdefault(category, []).append((filename, detail))
+        
+        with open(report_file, 'w', encoding='utf-8-sig' if sys.platform == 'win32' else 'utf-8') as f:
+            f.write("# Quarantine report\n")
+            f.write(f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"# Total files: {len(quarantined)}\n\n")
+            for category in sorted(by_category):
+                f.write(f"{category}:\n")
+                for filename, detail in by_category[category]:
+                    # ファイル名・詳細はJSON文字列（YAMLのダブルクォート文字列として有効）で出力
+                    f.write(f"  {json.dumps(filename, ensure_ascii=False)}: "
+                            f"{json.dumps(detail, ensure_ascii=False)}\n")
+                f.write("\n")
 
 
 # GUI版で使用されるため、インタラクティブモードは削除
@@ -306,6 +1433,15 @@ def show_error(message: str):
 
 def main():
     """メイン処理"""
+    # Windows環境でのエンコーディング問題を回避
+    if sys.platform == 'win32':
+        import codecs
+        # stdout/stderrをUTF-8でラップ
+        if hasattr(sys.stdout, 'buffer'):
+            sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+        if hasattr(sys.stderr, 'buffer'):
+            sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+    
     try:
         parser = argparse.ArgumentParser(
             description='PNG画像からStable Diffusionのポジティブプロンプトを抽出します'
@@ -322,9 +1458,61 @@ def main():
             default=4,
             help='並列処理のワーカー数（デフォルト: 4）'
         )
+        parser.add_argument(
+            '--serve',
+            action='store_true',
+            help='HTTPサーバーとして常駐し、アップロードされた画像を処理'
+        )
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='--serve時の待ち受けアドレス（デフォルト: 127.0.0.1）'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8765,
+            help='--serve時の待ち受けポート（デフォルト: 8765）'
+        )
+        parser.add_argument(
+            '--no-triage',
+            action='store_true',
+            help='抽出前の破損ファイルの確認を行わない'
+        )
+        parser.add_argument(
+            '--verify-crc',
+            action='store_true',
+            help='破損ファイルの確認でメタデータチャンクのCRCも照合'
+        )
+        parser.add_argument(
+            '--read-timeout',
+            type=float,
+            default=TRIAGE_TIMEOUT_SECONDS,
+            help=f'破損ファイルの確認・抽出の1ファイルあたりの制限時間（秒、デフォルト: {TRIAGE_TIMEOUT_SECONDS:g}）'
+        )
+        parser.add_argument(
+            '--triage-workers',
+            type=int,
+            default=2,
+            help='破損ファイルの確認に使うスレッド数（デフォルト: 2）'
+        )
+        parser.add_argument(
+            '--spill-dir',
+            help='抽出結果を一時ファイルに書き出してメモリ使用量を抑える場合の書き出し先フォルダ'
+        )
+        parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help='同一内容のファイルを検出し、同じプロンプトは1回だけ出力'
+        )
         
         args = parser.parse_args()
         
+        if args.serve:
+            from prompt_server import serve
+            serve(args.host, args.port, args.workers)
+            return
+        
         # フォルダパスを確認
         target_folder = Path(args.target_folder).resolve()
         if not target_folder.exists():
@@ -338,7 +1526,16 @@ def main():
         print(f"対象フォルダ: {target_folder}")
         
         # 処理実行
-        processor = PromptProcessor(target_folder, max_workers=args.workers)
+        processor = PromptProcessor(
+            target_folder,
+            max_workers=args.workers,
+            dedup=args.dedup,
+            triage=not args.no_triage,
+            check_crc=args.verify_crc,
+            read_timeout=args.read_timeout,
+            triage_workers=args.triage_workers,
+            spill_dir=Path(args.spill_dir) if args.spill_dir else None
+        )
         output_file, success_count, error_count, elapsed_time = processor.process_folder()
         
         # PNG画像が見つからなかった場合の処理
@@ -33,7 +33,7 @@ def main():
         "Stable Diffusionプロンプト抽出ツール",
         "PNG画像からStable Diffusionのプロンプトを抽出します。\n\n"
         "機能:\n"
-        "・最大1,000枚のPNG画像を一括処理\n"
+        "・フォルダ内のPNG画像を一括処理\n"
         "・マルチスレッドによる高速処理\n"
         "・抽出結果をテキストファイルに保存\n\n"
         "次の画面で画像が含まれるフォルダを選択してください。"
@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロンプト抽出HTTPサーバー
+PromptExtractorのワーカーを常駐させ、画像のアップロードやフォルダ指定で
+プロンプトをJSONで返す（外部ライブラリ不要のasyncio実装）
+
+エンドポイント:
+    POST /extract   画像1枚（本文がPNGデータ）またはmultipart/form-dataで複数枚
+    POST /folder    {"path": "..."} で指定したフォルダを処理し、NDJSONで逐次返す
+    GET  /metrics   処理件数・スループット・レイテンシ（Prometheusテキスト形式）
+    GET  /health    死活確認
+"""
+
+import json
+import time
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, List, Dict, Set
+
+from extract_prompts import PromptExtractor, iter_prompts, extract_many
+
+
+# レイテンシヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# バッチサイズヒストグラムの区切り（件）
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+# メトリクスでパスごとに集計するエンドポイント
+KNOWN_PATHS = ('/extract', '/folder', '/metrics', '/health')
+
+# 同時実行数の上限をかけるエンドポイント（本文の読み込み前に枠を確保する）
+LIMITED_PATHS = ('/extract', '/folder')
+
+# リクエスト本文の上限サイズ
+MAX_BODY_BYTES = 256 * 1024 * 1024
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class HTTPError(Exception):
+    """HTTPエラーレスポンスとして返す例外"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Histogram:
+    """Prometheus形式の累積ヒストグラム"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = '') -> List[str]:
+        lines = []
+        cumulative = 0
+        sep = ',' if labels else ''
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.total:.6f}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+class _Metrics:
+    """サーバーの処理統計"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.latency: Dict[str, _Histogram] = {}
+        self.batch_size = _Histogram(BATCH_SIZE_BUCKETS)
+        self.images = 0
+        self.prompts_found = 0
+        self.in_flight = 0
+
+    def record_request(self, path: str, status: int, elapsed: float):
+        key = (path, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        if path not in self.latency:
+            self.latency[path] = _Histogram(LATENCY_BUCKETS)
+        self.latency[path].observe(elapsed)
+
+    def record_images(self, prompts: List[Optional[str]]):
+        self.images += len(prompts)
+        self.prompts_found += sum(1 for prompt in prompts if prompt)
+
+    def render(self) -> str:
+        uptime = time.monotonic() - self.started
+        lines = [
+            '# TYPE prompt_server_uptime_seconds gauge',
+            f'prompt_server_uptime_seconds {uptime:.3f}',
+            '# TYPE prompt_server_images_total counter',
+            f'prompt_server_images_total {self.images}',
+            '# TYPE prompt_server_prompts_found_total counter',
+            f'prompt_server_prompts_found_total {self.prompts_found}',
+            '# TYPE prompt_server_images_per_second gauge',
+            f'prompt_server_images_per_second {self.images / uptime if uptime else 0:.3f}',
+            '# TYPE prompt_server_requests_in_flight gauge',
+            f'prompt_server_requests_in_flight {self.in_flight}',
+            '# TYPE prompt_server_requests_total counter',
+        ]
+        for (path, status), count in sorted(self.requests.items()):
+            lines.append(f'prompt_server_requests_total{{path="{path}",status="{status}"}} {count}')
+        lines.append('# TYPE prompt_server_request_seconds histogram')
+        for path, histogram in sorted(self.latency.items()):
+            lines.extend(histogram.render('prompt_server_request_seconds', f'path="{path}"'))
+        lines.append('# TYPE prompt_server_batch_size histogram')
+        lines.extend(self.batch_size.render('prompt_server_batch_size'))
+        return '\n'.join(lines) + '\n'
+
+
+class PromptServer:
+    """PromptExtractorのワーカープールを常駐させるHTTPサーバー"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, workers: int = 4,
+                 max_concurrency: int = 16, max_batch: int = 32,
+                 batch_delay: float = 0.005, max_body_bytes: int = MAX_BODY_BYTES):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.max_body_bytes = max_body_bytes
+        self.extractor = PromptExtractor()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract')
+        self.metrics = _Metrics()
+        self.logger = logging.getLogger(__name__)
+        self._max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """ワーカーを起動してから接続の受け付けを開始"""
+        loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._queue = asyncio.Queue()
+
+        # 全ワーカースレッドを先に起動しておく
+        await asyncio.gather(*(
+            loop.run_in_executor(self.executor, time.sleep, 0.01)
+            for _ in range(self.workers)
+        ))
+
+        self._batch_task = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # port=0 の場合は割り当てられたポートを反映
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info(f"サーバーを起動しました: http://{self.host}:{self.port}")
+
+    async def serve_forever(self):
+        """サーバーを起動し、停止されるまで待機"""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """サーバーを停止し、処理中のバッチを待ってからワーカーを停止"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+        # バッチに入らなかったリクエストは取り消す（start()前ならキューはない）
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        # スレッドの終了待ちでイベントループを止めない
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def extract(self, data) -> Optional[str]:
+        """
+        PNGデータ1件をバッチ処理キューに入れて結果を待つ
+
+        Args:
+            data: PNGデータ（bytes / memoryview）
+
+        Returns:
+            抽出したプロンプト文字列、見つからない場合はNone
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((data, future))
+        return await future
+
+    async def _batch_loop(self):
+        """キューに溜まった画像をまとめてワーカーに渡す"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.metrics.batch_size.observe(len(batch))
+            # 複数のバッチを並行してワーカーで処理（close()で待つため参照を保持）
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[tuple]):
+        """1バッチを最大workers個に分けてワーカースレッドで並行処理し、待機中のリクエストに結果を返す"""
+        loop = asyncio.get_running_loop()
+        # 各ワーカーに1つずつ渡し、分けた単位の中では逐次処理する
+        slices = [batch[i::self.workers] for i in range(min(self.workers, len(batch)))]
+        outcomes = await asyncio.gather(*(
+            loop.run_in_executor(
+                self.executor, extract_many, [data for data, _ in part], 1, None, self.extractor
+            )
+            for part in slices
+        ), return_exceptions=True)
+        for part, results in zip(slices, outcomes):
+            if isinstance(results, BaseException):
+                for _, future in part:
+                    if not future.done():
+                        future.set_exception(results)
+                continue
+            self.metrics.record_images([result.prompt for result in results])
+            for (_, future), result in zip(part, results):
+                if not future.done():
+                    future.set_result(result.prompt)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """1接続分のリクエストを処理（keep-alive対応）"""
+        try:
+            while True:
+                head = await self._read_head(reader)
+                if head is None:
+                    break
+                method, path, headers, length = head
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if path in LIMITED_PATHS:
+                    # 同時に読み込む本文の量も抑えるため、本文の前に枠を確保
+                    async with self._semaphore:
+                        body = await self._read_body(reader, length)
+                        await self._dispatch(method, path, headers, body, writer, keep_alive)
+                else:
+                    body = await self._read_body(reader, length)
+                    await self._dispatch(method, path, headers, body, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            # ヘッダーを読み終える前のエラーはパス不明として記録
+            self.metrics.record_request('other', e.status, 0.0)
+            await self._send_json(writer, e.status, {'error': str(e)}, keep_alive=False)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_head(self, reader: asyncio.StreamReader):
+        """
+        リクエスト行とヘッダーを読み込む
+
+        Returns:
+            (メソッド, パス, ヘッダー, 本文の長さ) のタプル、接続が閉じられた場合はNone
+        """
+        request_line = await self._read_line(reader, 400, 'リクエスト行が長すぎます')
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, 'リクエスト行が不正です')
+
+        headers = {}
+        while True:
+            line = await self._read_line(reader, 431, 'ヘッダーが長すぎます')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'transfer-encoding' in headers:
+            raise HTTPError(411, 'Content-Lengthを指定してください')
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(400, 'Content-Lengthが不正です')
+        if length < 0:
+            raise HTTPError(400, 'Content-Lengthが不正です')
+        if length > self.max_body_bytes:
+            raise HTTPError(413, f'本文が上限({self.max_body_bytes}バイト)を超えています')
+
+        path = target.split('?', 1)[0]
+        return method.upper(), path, headers, length
+
+    @staticmethod
+    async def _read_line(reader: asyncio.StreamReader, status: int, message: str) -> bytes:
+        """1行を読み込む（StreamReaderの上限を超える行はHTTPErrorにする）"""
+        try:
+            return await reader.readline()
+        except (asyncio.LimitOverrunError, ValueError):
+            raise HTTPError(status, message)
+
+    async def _read_body(self, reader: asyncio.StreamReader, length: int) -> bytes:
+        """Content-Length分の本文を読み込む"""
+        if not length:
+            return b''
+        return await reader.readexactly(length)
+
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes,
+                        writer: asyncio.StreamWriter, keep_alive: bool):
+        """パスに応じて処理を振り分け、レイテンシを記録"""
+        start = time.perf_counter()
+        status = 200
+        self.metrics.in_flight += 1
+        try:
+            if path == '/health':
+                await self._send_json(writer, 200, {'status': 'ok'}, keep_alive)
+            elif path == '/metrics':
+                await self._send(writer, 200, self.metrics.render().encode('utf-8'),
+                                 'text/plain; version=0.0.4; charset=utf-8', keep_alive)
+            elif path in ('/extract', '/folder'):
+                if method != 'POST':
+                    raise HTTPError(405, 'POSTで送信してください')
+                if path == '/extract':
+                    await self._handle_extract(headers, body, writer, keep_alive)
+                else:
+                    await self._handle_folder(body, writer, keep_alive)
+            else:
+                raise HTTPError(404, f'不明なパスです: {path}')
+        except HTTPError as e:
+            status = e.status
+            await self._send_json(writer, e.status, {'error': str(e)}, keep_alive)
+        except Exception as e:
+            status = 500
+            self.logger.error(f"処理エラー ({path}): {str(e)}")
+            await self._send_json(writer, 500, {'error': str(e)}, keep_alive)
+        finally:
+            self.metrics.in_flight -= 1
+            label = path if path in KNOWN_PATHS else 'other'
+            self.metrics.record_request(label, status, time.perf_counter() - start)
+
+    async def _handle_extract(self, headers: Dict[str, str], body: bytes,
+                              writer: asyncio.StreamWriter, keep_alive: bool):
+        """アップロードされた画像からプロンプトを抽出"""
+        content_type = headers.get('content-type', '')
+        if content_type.lower().startswith('multipart/form-data'):
+            parts = _parse_multipart(body, content_type)
+            prompts = await asyncio.gather(*(self.extract(data) for _, data in parts))
+            results = [
+                {'name': name, 'prompt': prompt}
+                for (name, _), prompt in zip(parts, prompts)
+            ]
+            await self._send_json(writer, 200, {'results': results}, keep_alive)
+        else:
+            if not body:
+                raise HTTPError(400, '画像データがありません')
+            prompt = await self.extract(memoryview(body))
+            await self._send_json(writer, 200, {'prompt': prompt}, keep_alive)
+
+    async def _handle_folder(self, body: bytes, writer: asyncio.StreamWriter, keep_alive: bool):
+        """フォルダ内のPNG画像を処理し、1件ごとにNDJSONで返す"""
+        try:
+            folder = Path(json.loads(body or b'{}')['path'])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, '{"path": "..."} の形式で指定してください')
+        if not folder.is_dir():
+            raise HTTPError(400, f'ディレクトリではありません: {folder}')
+
+        loop = asyncio.get_running_loop()
+        results = iter_prompts(folder.glob('*.png'), executor=self.executor,
+                               max_pending=self.workers * 2, extractor=self.extractor,
+                               triage=True)
+
+        await self._send_headers(writer, 200, 'application/x-ndjson; charset=utf-8', keep_alive,
+                                 [('Transfer-Encoding', 'chunked')])
+        count = 0
+        try:
+            while True:
+                # ジェネレーターはイベントループ外で進める
+                result = await loop.run_in_executor(None, next, results, None)
+                if result is None:
+                    break
+                count += 1
+                self.metrics.record_images([result.prompt])
+                line = {'name': result.source.name, 'prompt': result.prompt}
+                if result.problem:
+                    line['error'] = result.problem[0]
+                await self._send_chunk(writer, (json.dumps(line, ensure_ascii=False) + '\n').encode('utf-8'))
+            await self._send_chunk(writer, (json.dumps({'done': True, 'count': count}) + '\n').encode('utf-8'))
+        except ConnectionError:
+            raise
+        except Exception as e:
+            # ヘッダー送信後のため、エラーは最終行として返す
+            self.logger.error(f"処理エラー ({folder}): {str(e)}")
+            await self._send_chunk(writer, (json.dumps({'error': str(e)}, ensure_ascii=False) + '\n').encode('utf-8'))
+        finally:
+            await loop.run_in_executor(None, results.close)
+        await self._send_chunk(writer, b'')
+
+    async def _send_headers(self, writer: asyncio.StreamWriter, status: int, content_type: str,
+                            keep_alive: bool, extra: List[Tuple[str, str]]):
+        lines = [
+            f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}',
+            f'Content-Type: {content_type}',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+        ]
+        lines.extend(f'{name}: {value}' for name, value in extra)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def _send_chunk(self, writer: asyncio.StreamWriter, data: bytes):
+        writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+        await writer.drain()
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, body: bytes,
+                    content_type: str, keep_alive: bool):
+        await self._send_headers(writer, status, content_type, keep_alive,
+                                 [('Content-Length', str(len(body)))])
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, data, keep_alive: bool):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        await self._send(writer, status, body, 'application/json; charset=utf-8', keep_alive)
+
+
+def _parse_multipart(body: bytes, content_type: str) -> List[Tuple[str, memoryview]]:
+    """
+    multipart/form-dataの本文を分割
+
+    各パートのデータは本文のmemoryviewとして返し、コピーしない。
+
+    Args:
+        body: リクエスト本文
+        content_type: Content-Typeヘッダーの値
+
+    Returns:
+        (ファイル名, データ) のリスト
+    """
+    boundary = None
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.strip().partition('=')
+        if name.lower() == 'boundary':
+            boundary = value.strip('"')
+    if not boundary:
+        raise HTTPError(400, 'multipartのboundaryがありません')
+
+    delimiter = b'--' + boundary.encode('latin-1')
+    view = memoryview(body)
+    parts = []
+    pos = body.find(delimiter)
+    if pos == -1:
+        raise HTTPError(400, 'multipartの形式が不正です')
+    while True:
+        pos += len(delimiter)
+        if body[pos:pos + 2] == b'--':
+            break
+        header_end = body.find(b'\r\n\r\n', pos)
+        next_pos = body.find(delimiter, pos)
+        if header_end == -1 or next_pos == -1 or header_end > next_pos:
+            raise HTTPError(400, 'multipartの形式が不正です')
+
+        name = f'file{len(parts)}'
+        for line in body[pos:header_end].decode('utf-8', errors='replace').split('\r\n'):
+            if line.lower().startswith('content-disposition:'):
+                for param in line.split(';')[1:]:
+                    key, _, value = param.strip().partition('=')
+                    if key.lower() == 'filename' and value:
+                        name = value.strip('"')
+
+        # パート末尾の \r\n は区切りの一部
+        parts.append((name, view[header_end + 4:next_pos - 2]))
+        pos = next_pos
+    return parts
+
+
+def serve(host: str = '127.0.0.1', port: int = 8765, workers: int = 4, **kwargs):
+    """
+    サーバーを起動し、Ctrl+Cで停止するまで処理を続ける
+
+    Args:
+        host: 待ち受けアドレス
+        port: 待ち受けポート
+        workers: 抽出ワーカー数
+        **kwargs: PromptServerへのその他の引数
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = PromptServer(host, port, workers, **kwargs)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("\nサーバーを停止しました。")
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='プロンプト抽出HTTPサーバーを起動します')
+    parser.add_argument('--host', default='127.0.0.1', help='待ち受けアドレス（デフォルト: 127.0.0.1）')
+    parser.add_argument('--port', type=int, default=8765, help='待ち受けポート（デフォルト: 8765）')
+    parser.add_argument('--workers', type=int, default=4, help='抽出ワーカー数（デフォルト: 4）')
+    parser.add_argument('--max-concurrency', type=int, default=16,
+                        help='同時に処理するリクエスト数の上限（デフォルト: 16）')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, max_concurrency=args.max_concurrency)
+
+
+if __name__ == '__main__':
+    main()
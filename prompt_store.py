@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+抽出結果の省メモリストア
+大量の (ファイル名, プロンプト) を、1つのUTF-8バッファとオフセット配列、
+整数IDに置き換えたタグ列で保持する
+"""
+
+import mmap
+import hashlib
+import tempfile
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Optional, Tuple, List, Dict, Iterator
+
+
+# タグの区切り
+TAG_SEPARATOR = ','
+TAG_JOINER = ', '
+
+
+class _Buffer:
+    """追記専用のバイト列（メモリ上、またはメモリマップしたファイル）"""
+
+    def __init__(self, spill_dir: Optional[Path] = None):
+        self._spill = spill_dir is not None
+        self._size = 0
+        self._frozen = False
+        if self._spill:
+            self._file = tempfile.TemporaryFile(dir=spill_dir, prefix='prompt_store_')
+            self._map: Optional[mmap.mmap] = None
+        else:
+            self._data = bytearray()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, data) -> int:
+        """
+        データを末尾に追加
+
+        Returns:
+            追加したデータの先頭位置
+        """
+        if self._frozen:
+            raise ValueError('freeze()後のバッファには追加できません')
+        offset = self._size
+        if self._spill:
+            self._file.write(data)
+        else:
+            self._data += data
+        self._size += len(data)
+        return offset
+
+    def freeze(self):
+        """追加を締め切り、以降のviewをコピーなしのmemoryviewにする"""
+        self._frozen = True
+
+    def view(self, start: int, end: int):
+        """
+        指定範囲のデータ
+
+        ファイルに書き出している場合とfreeze()後はmemoryviewを返し、コピーしない。
+        メモリ上で追加中のbytearrayは、memoryviewが残ると拡張できなくなるためコピーを返す。
+        """
+        if not self._spill:
+            if self._frozen:
+                return memoryview(self._data)[start:end]
+            return bytes(self._data[start:end])
+        if start >= end:
+            return b''
+        if self._map is None or len(self._map) < end:
+            # 追記された分を反映して割り当て直す（古いマップは参照がなくなれば解放される）
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[start:end]
+
+    def nbytes(self) -> int:
+        """メモリ上で使用しているバイト数（ファイルに書き出した分は含まない）"""
+        return 0 if self._spill else len(self._data)
+
+    def close(self):
+        if self._spill:
+            self._map = None
+            self._file.close()
+
+
+class PromptStore:
+    """
+    大量の抽出結果を省メモリで保持するストア
+
+    ファイル名とタグ化できないプロンプトは1つのUTF-8バッファとオフセット配列に、
+    カンマ区切りのプロンプトはタグをIDに置き換えた array('I') の列として保持する。
+    spill_dirを指定すると、大きなバッファはそのディレクトリの一時ファイルに書き出し、
+    読み出し時はメモリマップで参照する。
+
+    (ファイル名, プロンプト) のリストと同じように反復・len()・添字で参照できる。
+    """
+
+    _ids_itemsize = array('I').itemsize
+
+    def __init__(self, spill_dir: Optional[Path] = None):
+        self.spill_dir = spill_dir
+        # ファイル名: UTF-8バッファ + 各行の終端位置
+        self._names = _Buffer(spill_dir)
+        self._name_ends = array('Q')
+        # タグID列: array('I')のバイト列 + 各行の終端位置（要素数）
+        self._ids = _Buffer(spill_dir)
+        self._id_ends = array('I')
+        # タグ化できないプロンプトの行番号と、その本文
+        self._raw_rows = array('I')
+        self._raw = _Buffer(spill_dir)
+        self._raw_ends = array('Q')
+        # タグの語彙
+        self._tags: List[str] = []
+        self._tag_ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._name_ends)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def __getitem__(self, row: int) -> Tuple[str, str]:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self.filename(row), self.prompt(row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def freeze(self):
+        """
+        追加を締め切る
+
+        以降はメモリ上のバッファも含めて、読み出しがコピーなしのmemoryviewになる。
+        書き込み処理に渡す前に呼び出す。
+        """
+        self._names.freeze()
+        self._ids.freeze()
+        self._raw.freeze()
+
+    def append(self, filename: str, prompt: str) -> int:
+        """
+        結果を1件追加
+
+        Args:
+            filename: ファイル名
+            prompt: プロンプト文字列
+
+        Returns:
+            追加した行番号
+        """
+        row = len(self)
+        self._names.append(filename.encode('utf-8'))
+        self._name_ends.append(len(self._names))
+
+        tags = [tag.strip() for tag in prompt.split(TAG_SEPARATOR)]
+        if TAG_JOINER.join(tags) == prompt:
+            ids = array('I', (self._intern(tag) for tag in tags))
+            self._ids.append(ids.tobytes())
+        else:
+            # 空白や改行が独特なものはタグ化すると元に戻せないためそのまま保持
+            self._raw_rows.append(row)
+            self._raw.append(prompt.encode('utf-8'))
+            self._raw_ends.append(len(self._raw))
+        self._id_ends.append(len(self._ids) // self._ids_itemsize)
+        return row
+
+    def filename(self, row: int) -> str:
+        """行のファイル名"""
+        start = self._name_ends[row - 1] if row else 0
+        return str(self._names.view(start, self._name_ends[row]), 'utf-8')
+
+    def prompt(self, row: int) -> str:
+        """行のプロンプト"""
+        raw = self._raw_view(row)
+        if raw is not None:
+            return str(raw, 'utf-8')
+        return TAG_JOINER.join(self._tags[tag_id] for tag_id in self.tag_ids(row))
+
+    def prompt_key(self, row: int) -> bytes:
+        """
+        行のプロンプトを表すキー（同じプロンプトの行は同じ値になる）
+
+        プロンプト文字列を組み立てずに重複を数えるためのもので、
+        タグ化した行はタグID列、そうでない行はUTF-8の本文をそのまま使う。
+        """
+        kind, data = self._key_parts(row)
+        return kind + bytes(data)
+
+    def prompt_digest(self, row: int) -> int:
+        """
+        prompt_keyの64bitハッシュ値
+
+        キー本体を保持せずに大量の行の重複を数えるためのもので、キーのバイト列も作らない。
+        """
+        kind, data = self._key_parts(row)
+        digest = hashlib.blake2b(kind, digest_size=8)
+        digest.update(data)
+        return int.from_bytes(digest.digest(), 'little')
+
+    def tag_ids(self, row: int):
+        """
+        行のタグID列（タグ化していない行は空）
+
+        ファイルに書き出している場合とfreeze()後はmemoryviewで、コピーしない。
+        """
+        start = self._id_ends[row - 1] if row else 0
+        end = self._id_ends[row]
+        data = self._ids.view(start * self._ids_itemsize, end * self._ids_itemsize)
+        if isinstance(data, memoryview):
+            return data.cast('I')
+        ids = array('I')
+        ids.frombytes(data)
+        return ids
+
+    def tag(self, tag_id: int) -> str:
+        """タグIDに対応するタグ"""
+        return self._tags[tag_id]
+
+    @property
+    def vocabulary_size(self) -> int:
+        """異なるタグの数"""
+        return len(self._tags)
+
+    def nbytes(self) -> int:
+        """バッファとオフセット配列がメモリ上で使用しているおおよそのバイト数（語彙を除く）"""
+        arrays = (self._name_ends, self._id_ends, self._raw_rows, self._raw_ends)
+        return (
+            sum(len(a) * a.itemsize for a in arrays)
+            + self._names.nbytes() + self._ids.nbytes() + self._raw.nbytes()
+        )
+
+    def close(self):
+        """一時ファイルを削除"""
+        self._names.close()
+        self._ids.close()
+        self._raw.close()
+
+    def _key_parts(self, row: int):
+        """prompt_keyの種別（b'R' / b'I'）と、本文またはタグID列のデータ"""
+        raw = self._raw_view(row)
+        if raw is not None:
+            return b'R', raw
+        start = self._id_ends[row - 1] if row else 0
+        return b'I', self._ids.view(start * self._ids_itemsize, self._id_ends[row] * self._ids_itemsize)
+
+    def _raw_view(self, row: int):
+        """タグ化していない行の本文（タグ化した行はNone）"""
+        index = bisect_left(self._raw_rows, row)
+        if index < len(self._raw_rows) and self._raw_rows[index] == row:
+            start = self._raw_ends[index - 1] if index else 0
+            return self._raw.view(start, self._raw_ends[index])
+        return None
+
+    def _intern(self, tag: str) -> int:
+        """タグをIDに変換（未登録なら語彙に追加）"""
+        tag_id = self._tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self._tags)
+            self._tags.append(tag)
+            self._tag_ids[tag] = tag_id
+        return tag_id
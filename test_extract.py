@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 """
 テストスクリプト - プロンプト抽出機能の動作確認
+
+引数なしで実行するとtest_imagesにテスト画像を作成する。
+--check を付けると一時フォルダに各種のテスト画像を作成し、抽出結果を確認する。
 """
 
 import os
+import sys
+import argparse
+import tempfile
 from pathlib import Path
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
@@ -27,8 +33,479 @@ Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 12345, Size: 512x512"""
     img.save(filename, "PNG", pnginfo=metadata)
     print(f"テスト画像作成: {filename}")
 
+def save_png_with_chunks(filename: Path, chunks, size=(16, 16), color='white'):
+    """
+    テキストチャンクを指定してPNG画像を保存
+    
+    Args:
+        filename: 保存先
+        chunks: (種類, キー, 値) のリスト（種類は 'tEXt' / 'zTXt' / 'iTXt' / 'iTXt-z'）
+    """
+    metadata = PngInfo()
+    for chunk_type, key, value in chunks:
+        if chunk_type == 'tEXt':
+            metadata.add_text(key, value)
+        elif chunk_type == 'zTXt':
+            metadata.add_text(key, value, zip=True)
+        else:
+            metadata.add_itxt(key, value, zip=chunk_type == 'iTXt-z')
+    Image.new('RGB', size, color=color).save(filename, "PNG", pnginfo=metadata)
+
+class Checker:
+    """期待値と比較して結果を表示し、失敗数を数える"""
+    
+    def __init__(self):
+        self.failures = 0
+    
+    def expect(self, label: str, actual, expected):
+        if actual == expected:
+            print(f"  OK: {label}")
+        else:
+            self.failures += 1
+            print(f"  NG: {label}\n      期待値: {expected!r}\n      実際:   {actual!r}")
+    
+    def expect_true(self, label: str, condition: bool, detail=''):
+        if condition:
+            print(f"  OK: {label}")
+        else:
+            self.failures += 1
+            print(f"  NG: {label} {detail}")
+
+def create_text_chunk_fixtures(folder: Path):
+    """zTXt / iTXt / 巨大なチャンクのテスト画像を作成"""
+    save_png_with_chunks(folder / 'ztxt.png', [
+        ('zTXt', 'parameters', 'ztxt prompt, compressed\nNegative prompt: bad'),
+    ])
+    save_png_with_chunks(folder / 'itxt_z.png', [
+        ('iTXt-z', 'parameters', '1girl, 日本語のプロンプト\nSteps: 20'),
+    ])
+    save_png_with_chunks(folder / 'itxt.png', [
+        ('iTXt', 'Description', 'itxt description, uncompressed'),
+    ])
+    save_png_with_chunks(folder / 'prompt_key.png', [
+        ('tEXt', 'Prompt', 'prompt key, tEXt'),
+    ])
+    # ComfyUIのワークフローのような数MBのチャンクは読み飛ばす
+    workflow = '{"nodes": [' + ','.join('{"id": %d, "widgets": "%s"}' % (i, 'x' * 64) for i in range(40000)) + ']}'
+    save_png_with_chunks(folder / 'workflow.png', [
+        ('iTXt-z', 'workflow', workflow),
+        ('tEXt', 'parameters', 'after workflow, prompt\nNegative prompt: bad'),
+    ])
+    # 上限（1MB）を超えるparametersは切り詰める
+    save_png_with_chunks(folder / 'oversized.png', [
+        ('zTXt', 'parameters', 'huge, ' + 'z ' * (1024 * 1024)),
+    ])
+
+def check_text_chunks(checker: Checker, folder: Path):
+    """テキストチャンクの読み取りを確認"""
+    from extract_prompts import PromptExtractor, MAX_TEXT_CHUNK_BYTES
+    
+    print("テキストチャンク:")
+    extractor = PromptExtractor()
+    checker.expect("zTXt", extractor.extract_prompt_from_png(folder / 'ztxt.png'),
+                   'ztxt prompt, compressed')
+    checker.expect("iTXt（圧縮・日本語）", extractor.extract_prompt_from_png(folder / 'itxt_z.png'),
+                   '1girl, 日本語のプロンプト')
+    checker.expect("iTXt（非圧縮）", extractor.extract_prompt_from_png(folder / 'itxt.png'),
+                   'itxt description, uncompressed')
+    checker.expect("Promptキー", extractor.extract_prompt_from_png(folder / 'prompt_key.png'),
+                   'prompt key, tEXt')
+    checker.expect("数MBのワークフローの後のparameters",
+                   extractor.extract_prompt_from_png(folder / 'workflow.png'),
+                   'after workflow, prompt')
+    prompt = extractor.extract_prompt_from_png(folder / 'oversized.png')
+    checker.expect_true("上限を超えるparametersは切り詰め",
+                        prompt is not None and prompt.startswith('huge, z z')
+                        and len(prompt.encode('utf-8')) <= MAX_TEXT_CHUNK_BYTES,
+                        f"(長さ: {len(prompt) if prompt else None})")
+
+def check_library_api(checker: Checker, folder: Path):
+    """iter_prompts / extract_many / PromptProcessorのログ設定を確認"""
+    import logging
+    from extract_prompts import iter_prompts, extract_many, PromptProcessor
+    
+    print("ライブラリAPI:")
+    paths = sorted(folder.glob('*.png'))
+    results = {result.source.name: result.prompt
+               for result in iter_prompts(paths, workers=2, max_pending=1)}
+    checker.expect("iter_prompts は全ファイルの結果を返す", sorted(results), [path.name for path in paths])
+    checker.expect("iter_prompts の抽出結果", results.get('ztxt.png'), 'ztxt prompt, compressed')
+    
+    data = (folder / 'itxt_z.png').read_bytes()
+    results = extract_many([data, folder / 'ztxt.png', memoryview(data)], workers=2)
+    checker.expect("extract_many は入力順に返す",
+                   [(result.source, result.prompt) for result in results],
+                   [(0, '1girl, 日本語のプロンプト'),
+                    (folder / 'ztxt.png', 'ztxt prompt, compressed'),
+                    (2, '1girl, 日本語のプロンプト')])
+    
+    # メタデータのない画像でも、ステルス形式の確認のためにバッファ全体をコピーしない
+    import io
+    import extract_prompts
+    buffer = io.BytesIO()
+    Image.new('RGBA', (200, 160), color=(1, 2, 3, 255)).save(buffer, 'PNG')
+    copies = []
+    to_file = extract_prompts._BufferStream.to_file
+    extract_prompts._BufferStream.to_file = lambda stream: copies.append(stream) or to_file(stream)
+    try:
+        prompt = extract_many([memoryview(buffer.getvalue())], workers=1)[0].prompt
+    finally:
+        extract_prompts._BufferStream.to_file = to_file
+    checker.expect("メタデータなしのバッファはコピーせずに確認", (prompt, len(copies)), (None, 0))
+    
+    logger = logging.getLogger('extract_prompts')
+    handlers = list(logger.handlers)
+    processor = PromptProcessor(folder, max_workers=2)
+    processor.process_folder()
+    checker.expect("process_folder の後にハンドラが残らない", logger.handlers, handlers)
+    checker.expect("ロガーの伝播設定を変えない", logger.propagate, True)
+
+def embed_stealth(img: Image.Image, text: str, signature: bytes) -> Image.Image:
+    """NovelAI形式のステルスメタデータを最下位ビットに列優先で埋め込む"""
+    import gzip
+    import numpy as np
+    
+    use_alpha = signature.startswith(b'stealth_png')
+    payload = text.encode('utf-8')
+    if signature.endswith(b'comp'):
+        payload = gzip.compress(payload)
+    data = signature + (len(payload) * 8).to_bytes(4, 'big') + payload
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    
+    pixels = np.array(img.convert('RGBA' if use_alpha else 'RGB'))
+    height, width = pixels.shape[:2]
+    channels = pixels[:, :, 3:4] if use_alpha else pixels[:, :, :3]
+    # (列, 行, チャンネル) の順に並べて書き込む
+    flat = channels.transpose(1, 0, 2).copy().ravel()
+    flat[:len(bits)] = (flat[:len(bits)] & 0xFE) | bits
+    channels[:] = flat.reshape(width, height, -1).transpose(1, 0, 2)
+    return Image.fromarray(pixels)
+
+def create_stealth_fixtures(folder: Path):
+    """ステルスメタデータのテスト画像を作成"""
+    import json
+    
+    info = {
+        'Description': 'stealth novelai, alpha',
+        'Software': 'NovelAI',
+        'Comment': json.dumps({'prompt': 'stealth novelai, alpha'}),
+    }
+    base = Image.new('RGB', (200, 160), color=(120, 80, 40))
+    embed_stealth(base, json.dumps(info), b'stealth_pngcomp').save(folder / 'stealth_alpha.png')
+    embed_stealth(base, 'stealth rgb, info\nNegative prompt: bad',
+                  b'stealth_rgbinfo').save(folder / 'stealth_rgb.png')
+    # 高さが足りず、左端の列だけではシグネチャが収まらない画像
+    embed_stealth(Image.new('RGB', (64, 64), color='white'), 'stealth small, comp',
+                  b'stealth_pngcomp').save(folder / 'stealth_small.png')
+    Image.new('RGBA', (200, 160), color=(1, 2, 3, 255)).save(folder / 'stealth_none.png')
+
+def check_stealth(checker: Checker, folder: Path):
+    """ステルスメタデータの読み取りを確認"""
+    from extract_prompts import PromptExtractor
+    
+    print("ステルスメタデータ:")
+    extractor = PromptExtractor()
+    checker.expect("アルファ・gzip・NovelAIのJSON",
+                   extractor.extract_prompt_from_png(folder / 'stealth_alpha.png'),
+                   'stealth novelai, alpha')
+    checker.expect("RGB・非圧縮・parameters形式",
+                   extractor.extract_prompt_from_png(folder / 'stealth_rgb.png'),
+                   'stealth rgb, info')
+    checker.expect("高さ120未満（全体をデコード）",
+                   extractor.extract_prompt_from_png(folder / 'stealth_small.png'),
+                   'stealth small, comp')
+    checker.expect("メモリ上のデータ",
+                   extractor.extract_prompt_from_buffer((folder / 'stealth_alpha.png').read_bytes()),
+                   'stealth novelai, alpha')
+    checker.expect("ステルスなし", extractor.extract_prompt_from_png(folder / 'stealth_none.png'), None)
+
+def create_duplicate_fixtures(folder: Path):
+    """内容が同一のファイルと、プロンプトだけが同じファイルを作成"""
+    import shutil
+    
+    save_png_with_chunks(folder / 'dup_a.png', [('tEXt', 'parameters', 'same prompt, dup\nSteps: 20')])
+    shutil.copyfile(folder / 'dup_a.png', folder / 'dup_a_copy.png')
+    save_png_with_chunks(folder / 'dup_b.png', [('tEXt', 'parameters', 'same prompt, dup\nSteps: 20')],
+                         color='black')
+    save_png_with_chunks(folder / 'dup_other.png', [('tEXt', 'parameters', 'other prompt')])
+
+def check_duplicates(checker: Checker, folder: Path):
+    """ハッシュによる重複検出と--dedupの出力を確認"""
+    from extract_prompts import PromptExtractor, PromptProcessor
+    
+    print("重複:")
+    extractor = PromptExtractor()
+    prompt_a, hash_a = extractor.extract_prompt_with_hash(folder / 'dup_a.png')
+    prompt_copy, hash_copy = extractor.extract_prompt_with_hash(folder / 'dup_a_copy.png')
+    prompt_b, hash_b = extractor.extract_prompt_with_hash(folder / 'dup_b.png')
+    checker.expect("同一ファイルは同じハッシュ", hash_copy, hash_a)
+    checker.expect_true("画素が異なるファイルは別のハッシュ", hash_b != hash_a)
+    checker.expect("メタデータが同じなら同じプロンプト", (prompt_a, prompt_copy, prompt_b),
+                   ('same prompt, dup',) * 3)
+    
+    processor = PromptProcessor(folder, max_workers=2, dedup=True)
+    output_file, success_count, _, _ = processor.process_folder()
+    yaml_text = Path(output_file).read_text(encoding='utf-8-sig')
+    txt_text = Path(output_file).with_suffix('.txt').read_text(encoding='utf-8-sig')
+    checker.expect("処理件数", success_count, 4)
+    checker.expect_true("異なるプロンプトの数", '# Distinct prompts: 2\n' in yaml_text)
+    checker.expect("アンカーは1回だけ", yaml_text.count('&p1 |'), 1)
+    checker.expect("残りはエイリアスで参照", yaml_text.count('*p1'), 2)
+    checker.expect_true("名前順で先のファイルを元ファイルとしてduplicatesに記録",
+                        'duplicates:\n  dup_a_copy: dup_a\n' in yaml_text)
+    checker.expect("テキストでは1回だけ出力", txt_text.count('same prompt, dup'), 1)
+
+def create_corrupt_fixtures(folder: Path):
+    """破損ファイルと、拡張子だけPNGのJPEG画像を作成"""
+    import io
+    import piexif
+    
+    save_png_with_chunks(folder / 'valid.png', [('tEXt', 'parameters', 'valid prompt, ok')])
+    data = (folder / 'valid.png').read_bytes()
+    text_offset = data.index(b'tEXt') - 4  # チャンク長の位置
+    
+    (folder / 'zero.png').write_bytes(b'')
+    (folder / 'junk.png').write_bytes(b'this is not an image at all')
+    (folder / 'truncated.png').write_bytes(data[:len(data) // 2])
+    # チャンク長がPNG仕様の上限を超える
+    (folder / 'bad_chunk.png').write_bytes(
+        data[:text_offset] + b'\xff\xff\xff\xff' + data[text_offset + 4:])
+    # tEXtの本文を書き換え、CRCはそのまま
+    bad_crc = bytearray(data)
+    bad_crc[text_offset + 8] ^= 0x01
+    (folder / 'bad_crc.png').write_bytes(bytes(bad_crc))
+    
+    # JPEGにPNGの拡張子を付けたもの（EXIFのUserCommentにプロンプト）
+    exif = piexif.dump({'Exif': {piexif.ExifIFD.UserComment: b'jpeg prompt, exif'}})
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), color='red').save(buffer, 'JPEG', exif=exif)
+    (folder / 'jpeg_renamed.png').write_bytes(buffer.getvalue())
+
+def check_corrupt(checker: Checker, folder: Path):
+    """トリアージによる破損ファイルの分類と、制限時間による打ち切りを確認"""
+    import threading
+    from extract_prompts import PromptExtractor, iter_prompts
+    
+    print("破損ファイル:")
+    results = {result.source.name: result
+               for result in iter_prompts(sorted(folder.glob('*.png')), workers=2,
+                                          triage=True, check_crc=True)}
+    problems = {name: result.problem[0] for name, result in results.items() if result.problem}
+    checker.expect("分類", problems, {
+        'zero.png': 'zero_byte',
+        'junk.png': 'not_png',
+        'truncated.png': 'truncated',
+        'bad_chunk.png': 'bad_chunk',
+        'bad_crc.png': 'bad_crc',
+    })
+    checker.expect("正常なファイルは抽出", results['valid.png'].prompt, 'valid prompt, ok')
+    checker.expect("拡張子だけPNGのJPEGはPILで抽出", results['jpeg_renamed.png'].prompt, 'jpeg prompt, exif')
+    
+    # 読み込みが返ってこないファイルは抽出でも打ち切る
+    release = threading.Event()
+    
+    class StuckExtractor(PromptExtractor):
+        def extract_prompt_from_png(self, file_path):
+            if file_path.name == 'valid.png':
+                release.wait(30)
+            return super().extract_prompt_from_png(file_path)
+    
+    try:
+        results = {result.source.name: result
+                   for result in iter_prompts([folder / 'valid.png', folder / 'jpeg_renamed.png'],
+                                              workers=1, extractor=StuckExtractor(),
+                                              read_timeout=0.5)}
+    finally:
+        release.set()
+    checker.expect("制限時間を過ぎた抽出はtimeout",
+                   results['valid.png'].problem and results['valid.png'].problem[0], 'timeout')
+    checker.expect("残りのファイルは新しいスレッドで処理", results['jpeg_renamed.png'].prompt,
+                   'jpeg prompt, exif')
+
+def check_server(checker: Checker, folder: Path):
+    """localhostでサーバーを起動し、各エンドポイントを確認"""
+    import json
+    import asyncio
+    import time
+    import threading
+    import http.client
+    from prompt_server import PromptServer
+    
+    print("HTTPサーバー:")
+    server = PromptServer(host='127.0.0.1', port=0, workers=2)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+    
+    def request(method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+    
+    try:
+        status, body = request('POST', '/extract', (folder / 'ztxt.png').read_bytes())
+        checker.expect("/extract（本文がPNG）", (status, json.loads(body)),
+                       (200, {'prompt': 'ztxt prompt, compressed'}))
+        
+        boundary = 'test-boundary'
+        parts = []
+        for name in ('itxt_z.png', 'prompt_key.png'):
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                f'Content-Type: image/png\r\n\r\n'.encode('utf-8')
+                + (folder / name).read_bytes() + b'\r\n'
+            )
+        multipart = b''.join(parts) + f'--{boundary}--\r\n'.encode('utf-8')
+        
+        # 1つのバッチが複数のワーカースレッドに分かれて処理されることを確認
+        thread_names = set()
+        extract_buffer = server.extractor.extract_prompt_from_buffer
+        
+        def record_thread(data, source='<buffer>'):
+            thread_names.add(threading.current_thread().name)
+            time.sleep(0.05)
+            return extract_buffer(data, source)
+        
+        server.extractor.extract_prompt_from_buffer = record_thread
+        try:
+            status, body = request('POST', '/extract', multipart,
+                                   {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        finally:
+            del server.extractor.extract_prompt_from_buffer
+        checker.expect("/extract（multipart）", (status, json.loads(body)), (200, {'results': [
+            {'name': 'itxt_z.png', 'prompt': '1girl, 日本語のプロンプト'},
+            {'name': 'prompt_key.png', 'prompt': 'prompt key, tEXt'},
+        ]}))
+        checker.expect("multipartの画像は複数のワーカーで処理", len(thread_names), 2)
+        
+        status, body = request('POST', '/folder', json.dumps({'path': str(folder)}))
+        lines = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        prompts = {line['name']: line['prompt'] for line in lines[:-1]}
+        count = len(list(folder.glob('*.png')))
+        checker.expect("/folder（NDJSON）", (status, len(prompts), prompts.get('itxt.png'), lines[-1]),
+                       (200, count, 'itxt description, uncompressed', {'done': True, 'count': count}))
+        
+        status, _ = request('POST', '/extract', b'', {'Content-Length': '-1'})
+        checker.expect("不正なContent-Lengthは400", status, 400)
+        
+        status, _ = request('GET', '/health', headers={'X-Large': 'a' * 70000})
+        checker.expect("上限を超えるヘッダーは431", status, 431)
+        
+        status, body = request('GET', '/metrics')
+        metrics = body.decode('utf-8')
+        checker.expect_true("/metrics",
+                            status == 200 and 'prompt_server_requests_total{path="/extract",status="200"} 2' in metrics
+                            and 'prompt_server_batch_size_count' in metrics)
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        loop.close()
+
+def check_prompt_store(checker: Checker, folder: Path, spill_dir=None):
+    """PromptStoreの読み書きと、process_folderでの利用を確認（spill_dir指定時は一時ファイル）"""
+    from prompt_store import PromptStore
+    from extract_prompts import PromptProcessor
+    
+    print(f"PromptStore（{'一時ファイル' if spill_dir else 'メモリ上'}）:")
+    rows = [
+        ('a.png', 'masterpiece, 1girl, solo'),
+        ('b.png', 'odd  spacing,no space'),     # タグ化すると戻せない
+        ('c.png', 'line one,\nline two'),
+        ('d.png', ''),
+        ('画像.png', 'masterpiece, 1girl, solo'),
+    ]
+    with PromptStore(spill_dir) as store:
+        for filename, prompt in rows[:2]:
+            store.append(filename, prompt)
+        # 読み出した後に追加しても、新しい行を読める（一時ファイルはマップし直す）
+        first = store[0]
+        for filename, prompt in rows[2:]:
+            store.append(filename, prompt)
+        checker.expect("追加後の読み出し", (first, store[4]), (rows[0], rows[4]))
+        checker.expect("タグ化した行・しない行の往復", list(store), rows)
+        checker.expect("タグID列", [store.tag(tag_id) for tag_id in store.tag_ids(4)],
+                       ['masterpiece', '1girl', 'solo'])
+        checker.expect("タグ化しない行のタグID列は空", len(store.tag_ids(1)), 0)
+        checker.expect_true("同じプロンプトは同じキー",
+                            store.prompt_key(0) == store.prompt_key(4)
+                            and store.prompt_digest(0) == store.prompt_digest(4))
+        keys = {store.prompt_key(row) for row in range(4)}
+        digests = {store.prompt_digest(row) for row in range(4)}
+        checker.expect("異なるプロンプトは異なるキー", (len(keys), len(digests)), (4, 4))
+        
+        store.freeze()
+        checker.expect("freeze後はコピーせずに参照",
+                       (type(store.tag_ids(0)).__name__, list(store.tag_ids(0)), list(store)),
+                       ('memoryview', [0, 1, 2], rows))
+        try:
+            store.append('e.png', 'late')
+            appended = True
+        except ValueError:
+            appended = False
+        checker.expect("freeze後は追加できない", appended, False)
+    
+    # process_folderの出力（重複フォルダを処理し、--dedupの出力を確認）
+    processor = PromptProcessor(folder, max_workers=2, dedup=True, spill_dir=spill_dir)
+    output_file, success_count, _, _ = processor.process_folder()
+    txt_text = Path(output_file).with_suffix('.txt').read_text(encoding='utf-8-sig')
+    prompts = sorted(block.strip() for block in txt_text.split('---') if block.strip())
+    checker.expect("process_folderの出力", (success_count, prompts),
+                   (4, ['other prompt', 'same prompt, dup']))
+    if spill_dir:
+        checker.expect("一時ファイルは削除される", list(spill_dir.iterdir()), [])
+
+def run_checks() -> int:
+    """一時フォルダにテスト画像を作成して抽出結果を確認"""
+    checker = Checker()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        folder = Path(temp_dir)
+        create_text_chunk_fixtures(folder)
+        check_text_chunks(checker, folder)
+        check_library_api(checker, folder)
+        check_server(checker, folder)
+        
+        stealth_folder = folder / 'stealth'
+        stealth_folder.mkdir()
+        create_stealth_fixtures(stealth_folder)
+        check_stealth(checker, stealth_folder)
+        
+        duplicate_folder = folder / 'duplicates'
+        duplicate_folder.mkdir()
+        create_duplicate_fixtures(duplicate_folder)
+        check_duplicates(checker, duplicate_folder)
+        
+        check_prompt_store(checker, duplicate_folder)
+        spill_dir = folder / 'spill'
+        spill_dir.mkdir()
+        check_prompt_store(checker, duplicate_folder, spill_dir)
+        
+        corrupt_folder = folder / 'corrupt'
+        corrupt_folder.mkdir()
+        create_corrupt_fixtures(corrupt_folder)
+        check_corrupt(checker, corrupt_folder)
+    
+    if checker.failures:
+        print(f"\n{checker.failures}件の確認に失敗しました。")
+        return 1
+    print("\nすべての確認に成功しました。")
+    return 0
+
 def main():
     """テスト実行"""
+    parser = argparse.ArgumentParser(description='プロンプト抽出機能の動作確認')
+    parser.add_argument('--check', action='store_true',
+                        help='一時フォルダにテスト画像を作成し、抽出結果を確認')
+    args = parser.parse_args()
+    
+    if args.check:
+        sys.exit(run_checks())
+    
     # テストディレクトリを作成
     test_dir = Path("test_images")
     test_dir.mkdir(exist_ok=True)